@@ -5,10 +5,7 @@ from PyPDF2 import PdfReader
 def extract_pdf_text(pdf_path):
     try:
         reader = PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        return text
+        return "".join(page.extract_text() or "" for page in reader.pages)
     except Exception as e:
         return f"❌ Error reading PDF: {e}"
 
@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import shutil
+import subprocess
+import tempfile
+
+import faiss
+import numpy as np
+
+from services.ann_index import INDEX_TYPES, FLAT, build_index, choose_index_spec, reconstruct_all
+from services.chunk_store import ChunkStoreIndex, save_chunk_store_index
+from services.context_packing import SEPARATOR, estimate_tokens, pack_context
+from services.lexical_index import tokenize
+from services.pdf_parser import available_backends, iter_pages
+from services.vector_bundle import read_faiss_store
+from services.vector_codec import VECTOR_DTYPES, reduce_dims
+from services.vector_store_files import is_complete_store
+
+VECTOR_STORE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "vector_stores"))
+KB_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "kb"))
+
+
+def load_store_vectors(vector_store_dir):
+    """
+    Stack the vectors of every complete store under vector_store_dir.
+    """
+    matrices = []
+    for name in sorted(os.listdir(vector_store_dir)):
+        store_dir = os.path.join(vector_store_dir, name)
+        if name.startswith(".") or not is_complete_store(store_dir):
+            continue
+        matrices.append(reconstruct_all(faiss.read_index(os.path.join(store_dir, "index.faiss"))))
+    if not matrices:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.vstack(matrices).astype(np.float32)
+
+
+def percentile_ms(samples, pct):
+    return float(np.percentile(samples, pct)) * 1000
+
+
+def bench_ann(args):
+    rng = np.random.default_rng(0)
+    if args.synthetic:
+        vectors = rng.standard_normal((args.synthetic, args.dim)).astype(np.float32)
+        source = f"{args.synthetic} synthetic vectors"
+    else:
+        vectors = load_store_vectors(args.vector_store_dir)
+        source = f"{len(vectors)} vectors from {args.vector_store_dir}"
+    if len(vectors) <= args.queries:
+        print(f"❌ Not enough vectors ({len(vectors)}) for {args.queries} queries")
+        return
+
+    # Held-out vectors plus a little noise stand in for real questions.
+    order = rng.permutation(len(vectors))
+    base = vectors[order[args.queries:]]
+    queries = vectors[order[:args.queries]]
+    queries = queries + rng.standard_normal(queries.shape).astype(np.float32) * queries.std() * 0.05
+
+    # Recall is measured against exact search at full width, so it includes
+    # the loss from truncation and quantization.
+    exact = build_index(base, choose_index_spec(len(base), base.shape[1], FLAT)).search(queries, args.k)[1]
+    base, queries = reduce_dims(base, args.embed_dim), reduce_dims(queries, args.embed_dim)
+
+    print(f"🔍 {source}: {len(base)} indexed at {base.shape[1]} dims ({args.dtype}), {len(queries)} queries, k={args.k}\n")
+    print(f"{'type':<7} {'build s':>8} {'size MB':>8} {'p50 ms':>8} {'p95 ms':>8} {f'recall@{args.k}':>10}  params")
+    for index_type in args.types:
+        spec = choose_index_spec(len(base), base.shape[1], index_type, args.dtype)
+        try:
+            started = time.perf_counter()
+            index = build_index(base, spec)
+            build_s = time.perf_counter() - started
+        except RuntimeError as e:
+            print(f"{index_type:<7} ⚠️ could not build: {e}")
+            continue
+
+        latencies, results = [], []
+        for query in queries:
+            started = time.perf_counter()
+            _, ids = index.search(query[None, :], args.k)
+            latencies.append(time.perf_counter() - started)
+            results.append(ids[0])
+        results = np.array(results)
+
+        recall = np.mean([len(set(r) & set(e)) / args.k for r, e in zip(results, exact)])
+        size_mb = faiss.serialize_index(index).nbytes / (1024 * 1024)
+        params = {key: value for key, value in spec.items() if key != "type"}
+        print(
+            f"{spec['type']:<7} {build_s:>8.2f} {size_mb:>8.1f} {percentile_ms(latencies, 50):>8.3f} "
+            f"{percentile_ms(latencies, 95):>8.3f} {recall:>10.3f}  {params}"
+        )
+
+
+def find_pdfs(root):
+    return sorted(
+        os.path.join(dirpath, name)
+        for dirpath, _, filenames in os.walk(root)
+        for name in filenames
+        if name.lower().endswith(".pdf")
+    )
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def parse_corpus(backend, pdfs):
+    """
+    Worker side of the parser benchmark: parse every PDF page by page with one
+    backend in this (fresh) process and print the totals as JSON.
+    """
+    baseline_mb = peak_rss_mb()
+    pages = chars = failed = 0
+    started = time.perf_counter()
+    for pdf in pdfs:
+        try:
+            for _, text in iter_pages(pdf, backend):
+                pages += 1
+                chars += len(text)
+        except Exception as e:
+            print(f"⚠️ {backend} failed on {pdf}: {e}", file=sys.stderr)
+            failed += 1
+    seconds = time.perf_counter() - started
+    print(json.dumps({
+        "backend": backend, "pdfs": len(pdfs), "failed": failed, "pages": pages, "chars": chars,
+        "seconds": seconds, "baseline_mb": baseline_mb, "peak_mb": peak_rss_mb(),
+    }))
+
+
+def bench_parsers(args):
+    pdfs = find_pdfs(args.kb_dir)
+    if args.worker:
+        parse_corpus(args.worker, pdfs * args.repeat)
+        return
+    if not pdfs:
+        print(f"❌ No PDFs under {args.kb_dir}")
+        return
+
+    backends = args.backends or available_backends()
+    print(f"📚 {len(pdfs)} PDFs under {args.kb_dir}, parsed {args.repeat}x per backend, one process each\n")
+    print(f"{'backend':<10} {'pages':>7} {'seconds':>8} {'pages/s':>9} {'chars':>10} {'peak MB':>8} {'+MB':>7}")
+    for backend in backends:
+        # A fresh interpreter per backend keeps ru_maxrss from carrying over.
+        command = [
+            sys.executable, os.path.abspath(__file__), "parsers",
+            "--kb-dir", args.kb_dir, "--repeat", str(args.repeat), "--worker", backend,
+        ]
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"{backend:<10} ⚠️ worker failed: {result.stderr.strip().splitlines()[-1:]}")
+            continue
+        row = json.loads(result.stdout.strip().splitlines()[-1])
+        failed = f"  ({row['failed']} PDFs failed)" if row["failed"] else ""
+        print(
+            f"{backend:<10} {row['pages']:>7} {row['seconds']:>8.2f} {row['pages'] / max(row['seconds'], 1e-9):>9.1f} "
+            f"{row['chars']:>10} {row['peak_mb']:>8.1f} {row['peak_mb'] - row['baseline_mb']:>7.1f}{failed}"
+        )
+
+
+def make_term_queries(docs, count, terms_per_query, rng):
+    """
+    Exact-term questions: each samples a chunk and asks about its rarest
+    terms (names, numbers). Relevant chunks are those containing all of them.
+    """
+    token_sets = [set(tokenize(doc.page_content)) for doc in docs]
+    df = {}
+    for tokens in token_sets:
+        for token in tokens:
+            df[token] = df.get(token, 0) + 1
+    queries = []
+    for pos in rng.permutation(len(docs))[:count]:
+        rare = sorted(token_sets[pos], key=lambda token: (df[token], token))[:terms_per_query]
+        if len(rare) < terms_per_query or df[rare[0]] > len(docs) // 4:
+            continue
+        relevant = {i for i, tokens in enumerate(token_sets) if tokens.issuperset(rare)}
+        queries.append((int(pos), f"What does the document say about {' '.join(rare)}?", relevant))
+    return queries
+
+
+def bench_retrieval(args):
+    from langchain.chains.question_answering.stuff_prompt import PROMPT as STUFF_PROMPT
+
+    embeddings = None
+    if args.base_url:
+        from langchain_ollama import OllamaEmbeddings
+        embeddings = OllamaEmbeddings(model=args.embedding_model, base_url=args.base_url)
+    else:
+        print("⚠️ No --base-url/BASE_URL: dense queries use the source chunk's vector plus noise, an upper bound for dense recall\n")
+
+    rng = np.random.default_rng(0)
+    modes = [("dense", args.dense_k), ("dense", args.hybrid_k), ("hybrid", args.hybrid_k), ("packed", args.hybrid_k)]
+    results = {mode: {"hits": 0, "tokens": 0} for mode in modes}
+    total = 0
+    for name in sorted(os.listdir(args.vector_store_dir)):
+        store_dir = os.path.join(args.vector_store_dir, name)
+        if name.startswith(".") or not is_complete_store(store_dir):
+            continue
+        vectors, docs = read_faiss_store(store_dir)
+        queries = make_term_queries(docs, args.queries, args.terms, rng)
+        if not queries:
+            continue
+
+        # Rebuild as a chunk store so the BM25 tables exist, whatever the store's age.
+        tmp_dir = tempfile.mkdtemp(prefix="bench-retrieval-")
+        try:
+            save_chunk_store_index(tmp_dir, vectors, docs, index_type=FLAT, embed_dim=0, vector_dtype="float32")
+            store = ChunkStoreIndex(tmp_dir, embeddings)
+            for pos, question, relevant in queries:
+                if embeddings is not None:
+                    query_vector = np.asarray(embeddings.embed_query(question), dtype=np.float32)
+                else:
+                    query_vector = vectors[pos] + rng.standard_normal(vectors.shape[1]).astype(np.float32) * vectors.std() * 0.5
+                for mode, k in modes:
+                    if mode == "dense":
+                        retrieved = store.similarity_search_by_vector(query_vector, k=k)
+                    else:
+                        retrieved = store.hybrid_search_by_vector(question, query_vector, k=k, fetch_k=args.fetch_k)
+                    if mode == "packed":
+                        retrieved, _ = pack_context(retrieved, args.context_tokens)
+                    context = SEPARATOR.join(doc.page_content for doc in retrieved)
+                    prompt = STUFF_PROMPT.format(context=context, question=question)
+                    # Packing may cut the last passage, so a hit means the chunk's text was sent in full.
+                    results[(mode, k)]["hits"] += any(docs[i].page_content in context for i in relevant)
+                    results[(mode, k)]["tokens"] += estimate_tokens(prompt)
+                total += 1
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print(f"📄 {name[:12]}: {len(docs)} chunks, {len(queries)} exact-term questions")
+
+    if not total:
+        print(f"❌ No stores with usable questions under {args.vector_store_dir}")
+        return
+    baseline = results[modes[0]]["tokens"] / total
+    print(f"\n{total} questions; prompt tokens estimated at 4 chars/token, packed to {args.context_tokens} context tokens\n")
+    print(f"{'mode':<7} {'k':>3} {'hit rate':>9} {'prompt tok':>11} {'saved':>7}")
+    for mode, k in modes:
+        row = results[(mode, k)]
+        tokens = row["tokens"] / total
+        print(f"{mode:<7} {k:>3} {row['hits'] / total:>9.3f} {tokens:>11.0f} {1 - tokens / baseline:>7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the KB retrieval stack")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ann = commands.add_parser("ann", help="Recall@k and query latency per FAISS index type")
+    ann.add_argument("--vector-store-dir", default=VECTOR_STORE_DIR, help="Stores whose vectors are benchmarked")
+    ann.add_argument("--synthetic", type=int, default=0, help="Use N random vectors instead of stored ones")
+    ann.add_argument("--dim", type=int, default=768, help="Dimensions of synthetic vectors")
+    ann.add_argument("--queries", type=int, default=200, help="Held-out vectors used as queries")
+    ann.add_argument("--k", type=int, default=4)
+    ann.add_argument("--embed-dim", type=int, default=0, help="Matryoshka-truncate vectors to this width first")
+    ann.add_argument("--dtype", choices=VECTOR_DTYPES, default="float32", help="Stored vector type for flat/HNSW")
+    ann.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    ann.set_defaults(run=bench_ann)
+
+    parsers = commands.add_parser("parsers", help="Pages/s and peak RSS per PDF parser backend")
+    parsers.add_argument("--kb-dir", default=KB_DIR, help="PDFs under this folder are parsed")
+    parsers.add_argument("--backends", nargs="+", choices=available_backends(), default=None)
+    parsers.add_argument("--repeat", type=int, default=1, help="Parse the corpus this many times")
+    parsers.add_argument("--worker", choices=available_backends(), help=argparse.SUPPRESS)
+    parsers.set_defaults(run=bench_parsers)
+
+    retrieval = commands.add_parser("retrieval", help="Exact-term hit rate and prompt tokens: dense, hybrid BM25, packed")
+    retrieval.add_argument("--vector-store-dir", default=VECTOR_STORE_DIR, help="Stores whose chunks are queried")
+    retrieval.add_argument("--queries", type=int, default=50, help="Questions sampled per store")
+    retrieval.add_argument("--terms", type=int, default=2, help="Rare terms per question")
+    retrieval.add_argument("--dense-k", type=int, default=int(os.getenv("KB_RETRIEVAL_K", "4")), help="Baseline dense k")
+    retrieval.add_argument("--hybrid-k", type=int, default=int(os.getenv("KB_HYBRID_K", "3")))
+    retrieval.add_argument("--fetch-k", type=int, default=int(os.getenv("KB_HYBRID_FETCH_K", "20")),
+                           help="Candidates per list before fusion")
+    retrieval.add_argument("--context-tokens", type=int, default=int(os.getenv("ASK_KB_CONTEXT_TOKENS", "1024")),
+                           help="Context budget for the packed mode")
+    retrieval.add_argument("--base-url", default=os.getenv("BASE_URL"), help="Ollama server used to embed questions")
+    retrieval.add_argument("--embedding-model", default="nomic-embed-text")
+    retrieval.set_defaults(run=bench_retrieval)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,49 @@
 
 import os
+import json
+import time
 import hashlib
+import threading
+import itertools
+import queue
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import List
 import argparse
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_ollama import OllamaEmbeddings
-from langchain_community.vectorstores import FAISS
 
-Base_url = os.getenv("BASE_URL")
-
-def get_hashed_path(relative_path: str) -> str:
-    normalized = os.path.normpath(relative_path).replace("\\", "/")
-    return hashlib.sha256(normalized.encode()).hexdigest()
+from services.chunk_embedding_cache import ChunkEmbeddingCache
+from services.ann_index import INDEX_TYPES
+from services.chunk_store import ChunkStoreWriter
+from services.file_lock import FileLock
+from services.page_text_store import PageTextStore
+from services.pdf_parser import iter_page_documents
+from services.streaming_ingest import ingest_pages, iter_chunks
+from services.vector_codec import VECTOR_DTYPES
+from services.vector_bundle import build_bundle, read_faiss_store
+from services.vector_store_files import build_store_atomically, is_complete_store
 
+Base_url = os.getenv("BASE_URL")
 
-KB_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "KB"))
-VECTOR_STORE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "vector_stores"))
-CHUNK_SIZE = 500
-CHUNK_OVERLAP = 50
+# Same layout as services/kb_service.py, so the server loads what this script builds.
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+KB_ROOT = os.path.join(BASE_DIR, "kb")
+VECTOR_STORE_DIR = os.path.join(BASE_DIR, "vector_stores")
+LOCK_DIR = os.getenv("KB_LOCK_DIR", os.path.join(VECTOR_STORE_DIR, ".locks"))
+INGEST_STATE_FILE = os.path.join(VECTOR_STORE_DIR, ".ingest_state.json")
+BUNDLE_PATH = os.getenv("KB_VECTOR_BUNDLE", os.path.join(VECTOR_STORE_DIR, ".bundle", "vector_stores.kbpack"))
+PAGE_TEXT_DB = os.path.join(VECTOR_STORE_DIR, ".page_text", "pages.sqlite")
+EMBEDDING_MODEL_NAME = "nomic-embed-text"
+# Must match the on-demand build in services/kb_service.py: both write the same content-addressed stores.
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
 
 os.makedirs(VECTOR_STORE_DIR, exist_ok=True)
-embedding_model = OllamaEmbeddings(model="nomic-embed-text", base_url=Base_url)
+embedding_model = OllamaEmbeddings(model=EMBEDDING_MODEL_NAME, base_url=Base_url)
+chunk_embeddings = ChunkEmbeddingCache(os.path.join(VECTOR_STORE_DIR, ".chunk_cache", "embeddings.sqlite"), EMBEDDING_MODEL_NAME)
 
 def get_all_pdfs_recursively(folder: str) -> List[str]:
     return [
@@ -33,56 +53,360 @@ def get_all_pdfs_recursively(folder: str) -> List[str]:
         if file.lower().endswith(".pdf")
     ]
 
-def hash_path(filepath: str) -> str:
-    return hashlib.sha256(filepath.encode()).hexdigest()
-
 def hash_file_contents(filepath: str) -> str:
+    sha = hashlib.sha256()
     with open(filepath, "rb") as f:
-        file_bytes = f.read()
-    return hashlib.sha256(file_bytes).hexdigest()
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
 
-def embed_pdf(pdf_path: str, force=False):
-    relative_path = os.path.relpath(pdf_path, KB_ROOT)
-    doc_id = get_hashed_path(os.path.join("KB", relative_path))
-    out_dir = os.path.join(VECTOR_STORE_DIR, doc_id)
-    os.makedirs(out_dir, exist_ok=True)
+class IngestState:
+    """
+    mtime, size and checksum of every ingested PDF, from .ingest_state.json.
+    The file is read once per run; entries recorded by the run are merged
+    into it every save_interval seconds and by save(), under a file lock and
+    through a uniquely named temp file, so concurrent runs keep each other's entries.
+    """
 
-    print(f"\n🔗 {pdf_path} → {out_dir}")
-    checksum_file = os.path.join(out_dir, "checksum.txt")
-    current_checksum = hash_file_contents(pdf_path)
+    def __init__(self, path, save_interval=30):
+        self.path = path
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._entries = None
+        self._unsaved = {}
+        self._saved_at = time.monotonic()
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
 
-    if not force and os.path.exists(checksum_file):
-        with open(checksum_file, "r") as f:
-            old_checksum = f.read().strip()
-        if current_checksum == old_checksum:
-            print(f"✅ Skipped (no change): {pdf_path}")
+    def _loaded(self) -> dict:
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def get(self, pdf_path: str):
+        with self._lock:
+            return self._loaded().get(os.path.abspath(pdf_path))
+
+    def record(self, pdf_path: str, checksum: str):
+        st = os.stat(pdf_path)
+        entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "checksum": checksum}
+        with self._lock:
+            self._loaded()[os.path.abspath(pdf_path)] = entry
+            self._unsaved[os.path.abspath(pdf_path)] = entry
+            due = time.monotonic() - self._saved_at >= self.save_interval
+        if due:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, {}
+            self._saved_at = time.monotonic()
+        if not unsaved:
             return
-        else:
-            print(f"🔁 Updated: {pdf_path}")
-    else:
-        print(f"🆕 New: {pdf_path}")
+        with FileLock(os.path.join(LOCK_DIR, "ingest_state.lock")):
+            state = self._read()
+            state.update(unsaved)
+            tmp_file = f"{self.path}.tmp-{uuid.uuid4().hex}"
+            with open(tmp_file, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.path)
 
-    try:
-        loader = PyPDFLoader(pdf_path)
-        pages = loader.load()
-        print(f"📄 Loaded {len(pages)} pages")
+ingest_state = IngestState(INGEST_STATE_FILE)
 
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
-        )
-        docs = splitter.split_documents(pages)
-        print(f"✂️ Split into {len(docs)} chunks")
+def record_ingested(pdf_path: str, checksum: str):
+    ingest_state.record(pdf_path, checksum)
 
-        vectordb = FAISS.from_documents(docs, embedding_model)
-        vectordb.save_local(out_dir)
+def unchanged_since_last_ingest(pdf_path: str) -> bool:
+    """
+    Cheap mtime+size check against the last ingest, so unchanged PDFs are skipped without hashing.
+    """
+    entry = ingest_state.get(pdf_path)
+    if not entry:
+        return False
+    st = os.stat(pdf_path)
+    if (st.st_mtime_ns, st.st_size) != (entry["mtime_ns"], entry["size"]):
+        return False
+    return is_complete_store(os.path.join(VECTOR_STORE_DIR, entry["checksum"]))
 
-        with open(checksum_file, "w") as f:
-            f.write(current_checksum)
+def pending_checksum(pdf_path: str, force=False):
+    """
+    Return the content checksum if the PDF needs (re-)embedding, else None.
+    """
+    if not force and unchanged_since_last_ingest(pdf_path):
+        print(f"✅ Skipped (mtime/size unchanged): {pdf_path}")
+        return None
 
+    # Vector stores are content-addressed: identical PDFs share one store,
+    # and a PDF whose content changed gets a new one, so an existing store is up to date.
+    current_checksum = hash_file_contents(pdf_path)
+    out_dir = os.path.join(VECTOR_STORE_DIR, current_checksum)
+
+    print(f"\n🔗 {pdf_path} → {out_dir}")
+    if not force and is_complete_store(out_dir):
+        print(f"✅ Skipped (no change): {pdf_path}")
+        record_ingested(pdf_path, current_checksum)
+        return None
+    print(f"🆕 New: {pdf_path}")
+    return current_checksum
+
+def iter_pdf_pages(pdf_path: str, checksum: str):
+    """
+    (text, metadata) per page, one page at a time: from the shared page-text
+    store when the content was parsed before, else parsed and stored as it goes.
+    """
+    store = PageTextStore(PAGE_TEXT_DB)
+    if store.page_count(checksum) is not None:
+        return ((text, metadata) for _, text, metadata in store.iter_pages(checksum))
+    return store.store_pages(checksum, iter_page_documents(pdf_path))
+
+def make_splitter():
+    return RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+def parse_pages(pdf_path: str, checksum: str) -> int:
+    """
+    CPU-bound stage: parse a PDF into the shared page-text store, one page in
+    memory at a time, and return its page count. Content parsed before is
+    not parsed again. Top-level so it can run in a worker process.
+    """
+    store = PageTextStore(PAGE_TEXT_DB)
+    if store.page_count(checksum) is None:
+        store.put(checksum, iter_page_documents(pdf_path))
+    return store.page_count(checksum)
+
+def write_vector_store(pdf_path: str, checksum: str, build, force=False):
+    """
+    Publish the store built by build(tmp_dir) for checksum and record the PDF as ingested.
+    """
+    out_dir = os.path.join(VECTOR_STORE_DIR, checksum)
+
+    def build_into(tmp_dir):
+        build(tmp_dir)
+        with open(os.path.join(tmp_dir, "checksum.txt"), "w") as f:
+            f.write(checksum)
+
+    # Locked and published atomically, so a running server never reads a half-written store.
+    if build_store_atomically(out_dir, build_into, LOCK_DIR, force=force):
         print(f"💾 Embedded and saved: {out_dir}")
+    else:
+        print(f"✅ Skipped (built by another process): {pdf_path}")
+    record_ingested(pdf_path, checksum)
+
+def store_manifest_extra():
+    return {"embedding_model": EMBEDDING_MODEL_NAME, "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP}
+
+def embed_pdf(pdf_path: str, force=False, index_type=None, embed_dim=None, vector_dtype=None, batch_size=64,
+              memory_mb=None):
+    """
+    Stream one PDF page by page through the splitter and embed it batch_size
+    chunks at a time, so even very large PDFs are ingested in bounded memory.
+    """
+    checksum = pending_checksum(pdf_path, force=force)
+    if not checksum:
+        ingest_state.save()
+        return
 
+    def report(totals):
+        total = totals["page_count"] or "?"
+        print(f"⏳ {totals['pages']}/{total} pages, {totals['chunks']} chunks ({totals['cached']} cached)", flush=True)
+
+    def build(tmp_dir):
+        spec, totals = ingest_pages(
+            tmp_dir,
+            iter_pdf_pages(pdf_path, checksum),
+            make_splitter(),
+            # Only chunks whose text is not in the chunk cache are sent to Ollama.
+            lambda texts: chunk_embeddings.embed_documents(texts, embedding_model, batch_size=batch_size),
+            batch_size=batch_size,
+            memory_mb=memory_mb,
+            page_count=PageTextStore(PAGE_TEXT_DB).page_count(checksum),
+            progress=report,
+            index_type=index_type,
+            embed_dim=embed_dim,
+            vector_dtype=vector_dtype,
+            **store_manifest_extra(),
+        )
+        print(f"📄 Loaded {totals['pages']} pages")
+        print(f"🧮 Chunk embeddings: {totals['cached']} cached, {totals['chunks'] - totals['cached']} embedded")
+        print(f"🗂️ {spec['type']} index over {totals['chunks']} chunks")
+
+    try:
+        write_vector_store(pdf_path, checksum, build, force=force)
     except Exception as e:
         print(f"❌ Error processing {pdf_path}: {e}")
+    finally:
+        ingest_state.save()
+
+def embed_all_pipelined(pdfs: List[str], force=False, workers=None, embed_concurrency=4, batch_size=64, index_type=None,
+                        embed_dim=None, vector_dtype=None, memory_mb=None):
+    """
+    Overlap the three ingestion stages across PDFs: parsing into the page-text
+    store in a process pool, splitting pages streamed back from it into
+    batched embedding requests on a bounded thread pool, and a single writer
+    thread that appends each batch to its store as the embeddings arrive.
+    No stage holds a whole PDF's pages or chunks in memory.
+    """
+    started = time.perf_counter()
+    totals = {"pdfs": 0, "pages": 0, "chunks": 0, "cached": 0, "failed": 0}
+    totals_lock = threading.Lock()
+
+    pending = {}
+    for pdf_path in pdfs:
+        checksum = pending_checksum(pdf_path, force=force)
+        if checksum:
+            pending[pdf_path] = checksum
+    if not pending:
+        ingest_state.save()
+        print("\n✅ Nothing to embed")
+        return
+
+    # Caps chunk batches queued for embedding, in flight, or waiting for the
+    # writer, so chunks cannot pile up in memory faster than the embedding
+    # server and the writer drain them. Parsed pages wait on disk.
+    in_flight = threading.BoundedSemaphore(embed_concurrency * 2)
+    max_parsing = (workers or os.cpu_count() or 1) * 2
+    splitter = make_splitter()
+
+    def embed_batch(texts):
+        return chunk_embeddings.embed_documents(texts, embedding_model, batch_size=batch_size)
+
+    def write(pdf_path, batches):
+        # batches yields (docs, embedding future) in order, then None; an
+        # exception instead of None means the chunk stream broke off.
+        state = {"ended": False, "cached": 0}
+
+        def take():
+            item = batches.get()
+            if item is None or isinstance(item, Exception):
+                state["ended"] = True
+                if item is not None:
+                    raise item
+                return None
+            in_flight.release()
+            return item
+
+        def build(tmp_dir):
+            writer = ChunkStoreWriter(tmp_dir, embed_dim=embed_dim, memory_mb=memory_mb)
+            try:
+                count = 0
+                for docs, future in iter(take, None):
+                    batch_vectors, batch_hits = future.result()
+                    writer.add(docs, batch_vectors)
+                    state["cached"] += batch_hits
+                    count += len(docs)
+                spec = writer.finish(index_type, vector_dtype, **store_manifest_extra())
+            finally:
+                writer.close()
+            print(f"🗂️ {spec['type']} index over {count} chunks")
+
+        try:
+            write_vector_store(pdf_path, pending[pdf_path], build, force=force)
+            with totals_lock:
+                totals["pdfs"] += 1
+                totals["cached"] += state["cached"]
+        except Exception as e:
+            print(f"❌ Error writing {pdf_path}: {e}")
+            with totals_lock:
+                totals["failed"] += 1
+        finally:
+            # Batches a failed or skipped build did not consume still hold slots.
+            while not state["ended"]:
+                try:
+                    take()
+                except Exception:
+                    pass
+
+    def stream_chunks(pdf_path, batches):
+        batch, count = [], 0
+
+        def submit():
+            in_flight.acquire()
+            batches.put((batch, embed_pool.submit(embed_batch, [doc.page_content for doc in batch])))
+
+        try:
+            pages = ((text, metadata) for _, text, metadata in PageTextStore(PAGE_TEXT_DB).iter_pages(pending[pdf_path]))
+            for doc in iter_chunks(pages, splitter):
+                batch.append(doc)
+                count += 1
+                if len(batch) >= batch_size:
+                    submit()
+                    batch = []
+            if batch:
+                submit()
+            batches.put(None)
+        except Exception as e:
+            print(f"❌ Error splitting {pdf_path}: {e}")
+            batches.put(e)
+        return count
+
+    with ProcessPoolExecutor(max_workers=workers) as parse_pool, \
+            ThreadPoolExecutor(max_workers=embed_concurrency, thread_name_prefix="embed") as embed_pool, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer") as writer:
+        queued = iter(pending.items())
+        parse_futures = {}
+        write_futures = []
+
+        def submit_parses():
+            for path, checksum in itertools.islice(queued, max_parsing - len(parse_futures)):
+                parse_futures[parse_pool.submit(parse_pages, path, checksum)] = path
+
+        submit_parses()
+        while parse_futures:
+            done, _ = wait(parse_futures, return_when=FIRST_COMPLETED)
+            parsed = next(iter(done))
+            pdf_path = parse_futures.pop(parsed)
+            submit_parses()
+            try:
+                page_count = parsed.result()
+            except Exception as e:
+                print(f"❌ Error parsing {pdf_path}: {e}")
+                with totals_lock:
+                    totals["failed"] += 1
+                continue
+
+            batches = queue.Queue()
+            write_futures.append(writer.submit(write, pdf_path, batches))
+            chunk_count = stream_chunks(pdf_path, batches)
+            print(f"📄 {pdf_path}: {page_count} pages, {chunk_count} chunks")
+            with totals_lock:
+                totals["pages"] += page_count
+                totals["chunks"] += chunk_count
+
+        for future in write_futures:
+            future.result()
+    ingest_state.save()
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"\n📊 Embedded {totals['pdfs']} PDFs ({totals['failed']} failed) in {elapsed:.1f}s — "
+        f"{totals['pages'] / elapsed:.1f} pages/s, {totals['chunks'] / elapsed:.1f} chunks/s, "
+        f"{totals['cached']}/{totals['chunks']} chunks from cache"
+    )
+
+def build_vector_bundle(bundle_path: str):
+    """
+    Pack every complete vector store into one memory-mappable bundle file,
+    read by the server instead of unpickling each store directory.
+    """
+    started = time.perf_counter()
+    store_ids = [
+        name for name in sorted(os.listdir(VECTOR_STORE_DIR))
+        if not name.startswith(".") and is_complete_store(os.path.join(VECTOR_STORE_DIR, name))
+    ]
+
+    def stores():
+        for name in store_ids:
+            vectors, docs = read_faiss_store(os.path.join(VECTOR_STORE_DIR, name))
+            print(f"📥 {name}: {len(docs)} chunks")
+            yield name, vectors, docs
+
+    os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+    count = build_bundle(stores(), bundle_path)
+    size_mb = os.path.getsize(bundle_path) / (1024 * 1024)
+    print(f"\n📦 Bundled {count} stores into {bundle_path} ({size_mb:.1f} MB) in {time.perf_counter() - started:.1f}s")
 
 def list_embedded_files():
     print("\n📦 Embedded PDFs:")
@@ -93,8 +417,10 @@ def list_embedded_files():
 
 def find_orphans():
     print("\n🧹 Orphan Vectors (no matching PDF):")
-    known_hashes = {hash_path(p): p for p in get_all_pdfs_recursively(KB_ROOT)}
+    known_hashes = {hash_file_contents(p): p for p in get_all_pdfs_recursively(KB_ROOT)}
     for folder in os.listdir(VECTOR_STORE_DIR):
+        if folder.startswith("."):
+            continue
         if folder not in known_hashes:
             print("•", folder)
 
@@ -104,19 +430,45 @@ def main():
     parser.add_argument("--file", type=str, help="Path to a specific PDF")
     parser.add_argument("--list", action="store_true", help="List embedded PDFs")
     parser.add_argument("--orphans", action="store_true", help="List orphaned vector stores")
+    parser.add_argument("--build-bundle", action="store_true", help="Pack all vector stores into one mmap bundle")
+    parser.add_argument("--bundle-path", type=str, default=BUNDLE_PATH, help="Output path for --build-bundle")
+    parser.add_argument("--index-type", choices=("auto",) + INDEX_TYPES, default="auto",
+                        help="FAISS index type; 'auto' picks by vector count")
+    parser.add_argument("--embed-dim", type=int, default=None,
+                        help="Matryoshka-truncate vectors to this width (default: KB_EMBED_DIM, 0 keeps 768)")
+    parser.add_argument("--vector-dtype", choices=VECTOR_DTYPES, default=None,
+                        help="Stored vector type for flat/HNSW indexes (default: KB_VECTOR_DTYPE)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes used to parse PDFs")
+    parser.add_argument("--embed-concurrency", type=int, default=4, help="Concurrent embedding requests to Ollama")
+    parser.add_argument("--batch-size", type=int, default=64, help="Chunks per embedding request")
+    parser.add_argument("--memory-mb", type=float, default=None,
+                        help="Vectors held in memory per store before spilling to disk (default: KB_INGEST_MEMORY_MB)")
     args = parser.parse_args()
 
     if args.list:
         return list_embedded_files()
     if args.orphans:
         return find_orphans()
+    if args.build_bundle:
+        return build_vector_bundle(args.bundle_path)
     if args.file:
-        return embed_pdf(args.file, force=args.force)
+        return embed_pdf(args.file, force=args.force, index_type=args.index_type,
+                         embed_dim=args.embed_dim, vector_dtype=args.vector_dtype,
+                         batch_size=args.batch_size, memory_mb=args.memory_mb)
 
     pdfs = get_all_pdfs_recursively(KB_ROOT)
     print(f"\n🔍 Found {len(pdfs)} PDFs under '{KB_ROOT}'")
-    for path in pdfs:
-        embed_pdf(path, force=args.force)
+    embed_all_pipelined(
+        pdfs,
+        force=args.force,
+        workers=args.workers,
+        embed_concurrency=args.embed_concurrency,
+        batch_size=args.batch_size,
+        index_type=args.index_type,
+        embed_dim=args.embed_dim,
+        vector_dtype=args.vector_dtype,
+        memory_mb=args.memory_mb,
+    )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
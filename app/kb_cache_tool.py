@@ -0,0 +1,59 @@
+import argparse
+import os
+
+from dotenv import load_dotenv
+
+env = os.getenv("ENV", "development")
+load_dotenv(dotenv_path=f".env.{env}")
+
+from services import kb_service
+from services.vector_codec import VECTOR_DTYPES
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the KB answer cache and vector stores")
+    parser.add_argument("--backfill-content-hash", action="store_true",
+                        help="Tag legacy kb_answer_cache entries with the content hash of their PDF")
+    parser.add_argument("--backfill-query-keys", action="store_true",
+                        help="Add or refresh canonical query keys on kb_answer_cache entries and index them")
+    parser.add_argument("--migrate-vector-stores", action="store_true",
+                        help="Rename path-keyed vector stores to content-addressed directories")
+    parser.add_argument("--reencode-vector-stores", action="store_true",
+                        help="Rebuild vector stores from their stored vectors at --embed-dim / --vector-dtype")
+    parser.add_argument("--build-lexical-indexes", action="store_true",
+                        help="Add BM25 indexes for hybrid retrieval to chunk stores built without them")
+    parser.add_argument("--pack-cache-embeddings", action="store_true",
+                        help="Convert kb_answer_cache embeddings to packed BinData, truncated to --embed-dim")
+    parser.add_argument("--rebuild-semantic-index", action="store_true",
+                        help="Rebuild the answer-cache ANN index from kb_answer_cache")
+    parser.add_argument("--apply-cache-policy", action="store_true",
+                        help="Create TTL/eviction indexes and enforce the per-PDF answer cap")
+    parser.add_argument("--embed-dim", type=int, default=None,
+                        help="Matryoshka width for re-encoding (default: KB_EMBED_DIM)")
+    parser.add_argument("--vector-dtype", choices=VECTOR_DTYPES, default=None,
+                        help="Stored vector type for re-encoding (default: KB_VECTOR_DTYPE)")
+    args = parser.parse_args()
+
+    if args.backfill_content_hash:
+        kb_service.backfill_cache_content_hashes()
+    if args.backfill_query_keys:
+        kb_service.backfill_cache_query_keys()
+    if args.migrate_vector_stores:
+        kb_service.migrate_legacy_vector_stores()
+    if args.reencode_vector_stores:
+        kb_service.reencode_vector_stores(embed_dim=args.embed_dim, vector_dtype=args.vector_dtype)
+    if args.build_lexical_indexes:
+        kb_service.build_lexical_indexes()
+    if args.pack_cache_embeddings:
+        kb_service.pack_cache_embeddings(embed_dim=args.embed_dim)
+    if args.apply_cache_policy:
+        kb_service.apply_answer_cache_policy()
+    if args.rebuild_semantic_index:
+        count = kb_service.semantic_index.rebuild()
+        print(f"🧠 Rebuilt semantic cache index with {count} entries")
+    if not any(vars(args).values()):
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
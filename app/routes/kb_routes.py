@@ -1,23 +1,51 @@
 # routes/kb_routes.py
 
 import os
-from flask import Blueprint, request, jsonify
+from datetime import datetime, timezone
+from flask import Blueprint, request, jsonify, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt
 
 from services.kb_service import (
     list_kb_folders,
     list_kb_folder,
+    list_kb_folder_contents,
     list_specific_kb_folders,   # NEW import
+    kb_listing_etag,
     save_uploaded_pdf,
+    enqueue_pdf_ingest,
+    get_ingest_job,
+    IndexingInProgress,
+    IndexingFailed,
     ask_kb_path,
-    KB_ROOT,
-    read_kb_pdf,
+    resolve_kb_pdf,
+    stream_ask_kb,
+    resolve_kb_read_path,
+    iter_kb_pdf_pages,
+    kb_pdf_page_count,
+    get_content_hash,
     list_cached_questions,
     extract_text_from_pdf,
-    list_cached_questions
+    list_cached_questions,
+    get_kb_cache_stats,
+    get_answer_cache_admin_stats
 )
 from services.pg13_guard import pg13_guard
 
+def _listing_response(etag, build, not_found=None):
+    # Listings only change with the KB tree or the caller's ACL, both part of the ETag,
+    # so a matching ETag answers 304 without building the listing.
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        listing = build()
+        if listing is None:
+            return jsonify({"error": not_found}), 404
+        response = jsonify(listing)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
 def register_kb_routes(app):
     kb_bp = Blueprint("kb", __name__)
 
@@ -26,10 +54,8 @@ def register_kb_routes(app):
     def api_list_kb_folders():
         jwt_data = get_jwt()
         allowed_folders = jwt_data.get('allowed_folders', [])
-        print(allowed_folders)
-        print(f"🪪 JWT allowed_folders: {allowed_folders}")  # <<< add this
-        folders = list_specific_kb_folders(allowed_folders)
-        return jsonify(folders)
+        etag = kb_listing_etag("folders", sorted(allowed_folders))
+        return _listing_response(etag, lambda: list_specific_kb_folders(allowed_folders))
 
     @kb_bp.route("/list-kb-folder", methods=["GET"])
     @jwt_required()
@@ -41,38 +67,10 @@ def register_kb_routes(app):
         if not folder:
             return jsonify({"error": "No folder specified"}), 400
 
-        path = os.path.join(KB_ROOT, folder)
-        if not os.path.exists(path):
-            return jsonify({"error": "Folder not found"}), 404
-
-        contents = []
-
-        for f in os.listdir(path):
-            full_path = os.path.join(path, f)
-
-            if os.path.isdir(full_path):
-                full_folder_path = f"{folder}/{f}"
-                # ✅ Only allow subfolder if user has access
-                if "*" in allowed_folders or full_folder_path in allowed_folders:
-                    pdf_count = len([
-                        pdf for pdf in os.listdir(full_path)
-                        if os.path.isfile(os.path.join(full_path, pdf)) and pdf.endswith(".pdf")
-                    ])
-                    contents.append({
-                        "type": "folder",
-                        "name": f,
-                        "pdf_count": pdf_count
-                    })
-
-            elif f.endswith(".pdf"):
-                full_file_path = f"{folder}/{f}"
-                if "*" in allowed_folders or folder in allowed_folders or full_file_path in allowed_folders:
-                    contents.append({
-                        "type": "file",
-                        "name": f
-                    })
-
-        return jsonify(contents)
+        etag = kb_listing_etag("folder", folder, sorted(allowed_folders))
+        return _listing_response(
+            etag, lambda: list_kb_folder_contents(folder, allowed_folders), not_found="Folder not found"
+        )
 
     @kb_bp.route("/upload-kb-pdf", methods=["POST"])
     @jwt_required()
@@ -85,7 +83,25 @@ def register_kb_routes(app):
             return jsonify({"error": "Missing folder, subfolder, or file"}), 400
 
         safe_folder, safe_subfolder, filename = save_uploaded_pdf(folder, subfolder, file)
-        return jsonify({"message": f"✅ Uploaded {filename} to {safe_folder}/{safe_subfolder}"})
+        job_id = enqueue_pdf_ingest(f"{safe_folder}/{safe_subfolder}/{filename}")
+        return jsonify({
+            "message": f"✅ Uploaded {filename} to {safe_folder}/{safe_subfolder}",
+            "job_id": job_id
+        })
+
+    @kb_bp.route("/kb-ingest-status", methods=["GET"])
+    @jwt_required()
+    def api_kb_ingest_status():
+        job_id = request.args.get("job_id")
+        if not job_id:
+            return jsonify({"error": "Missing job_id"}), 400
+
+        job = get_ingest_job(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+
+        job["job_id"] = job.pop("_id")
+        return jsonify(job)
 
     @kb_bp.route("/ask-kb", methods=["POST"])
     @jwt_required()
@@ -101,33 +117,113 @@ def register_kb_routes(app):
         try:
             answer = ask_kb_path(path, query)
             return jsonify({"response": answer})
+        except IndexingInProgress as ip:
+            return jsonify({
+                "response": "⏳ This PDF is still being indexed. Please try again in a moment.",
+                "status": "indexing",
+                "job_id": ip.job_id
+            }), 202
+        except IndexingFailed as fail:
+            return jsonify({"error": str(fail), "status": "failed", "job_id": fail.job_id}), 422
         except FileNotFoundError as fe:
             return jsonify({"error": str(fe)}), 404
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
+    @kb_bp.route("/ask-kb-stream", methods=["POST"])
+    @jwt_required()
+    def api_ask_kb_stream():
+        data = request.get_json()
+        path = data.get("path")
+        query = data.get("message")
+
+        if not path or not query:
+            return jsonify({"error": "Missing path or message"}), 400
+
+        try:
+            full_path = resolve_kb_pdf(path)
+        except FileNotFoundError as fe:
+            return jsonify({"error": str(fe)}), 404
+
+        return Response(
+            stream_with_context(stream_ask_kb(path, full_path, query)),
+            content_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
     @kb_bp.route("/read-kb-pdf", methods=["POST", "GET"])
     @jwt_required()
     def read_kb_pdf_route():
+        """
+        Text of a KB PDF. Optional parameters:
+        start_page / end_page (1-based, inclusive), cursor (the next_cursor of a
+        previous response, overrides start_page), limit (pages per response)
+        and stream=1 for a chunked plain-text response written page by page.
+        """
         if request.method == "POST":
-            data = request.get_json()
-            path = data.get("path")
+            params = request.get_json(silent=True) or {}
         else:
-            path = request.args.get("path")
+            params = request.args
+        path = params.get("path")
 
         if not path:
             return jsonify({"error": "Missing path"}), 400
 
-        text = read_kb_pdf(path)
-        if not text:
+        full_path = resolve_kb_read_path(path)
+        if not full_path:
             return jsonify({"error": "Failed to read PDF"}), 404
 
-        # ➕ If GET request, return plain text for new tab preview
-        if request.method == "GET":
-            return text, 200, {'Content-Type': 'text/plain; charset=utf-8'}
-
-        # Else return JSON (used by TTS or frontend)
-        return jsonify({"text": text})
+        try:
+            start = int(params.get("cursor") or params.get("start_page") or 1) - 1
+            end = int(params["end_page"]) if params.get("end_page") else None
+            limit = int(params["limit"]) if params.get("limit") else None
+        except ValueError:
+            return jsonify({"error": "start_page, end_page, cursor and limit must be integers"}), 400
+        if start < 0 or (end is not None and end <= start) or (limit is not None and limit < 1):
+            return jsonify({"error": "Invalid page range"}), 400
+        if limit is not None:
+            end = start + limit if end is None else min(end, start + limit)
+        stream = str(params.get("stream", "")).lower() in ("1", "true", "yes")
+
+        # The PDF bytes fix the text, so the checksum validates every range of it.
+        content_hash = get_content_hash(full_path)
+        etag = f"{content_hash}-{start}-{end or ''}-{request.method}{'-stream' if stream else ''}"
+        last_modified = datetime.fromtimestamp(int(os.path.getmtime(full_path)), tz=timezone.utc)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+
+        if not_modified:
+            response = Response(status=304)
+        elif stream:
+            pages = iter_kb_pdf_pages(full_path, content_hash, start, end)
+            response = Response(
+                stream_with_context(text + "\n" for _, text in pages),
+                content_type="text/plain; charset=utf-8",
+                headers={"X-Accel-Buffering": "no"}
+            )
+        else:
+            text = "\n".join(text for _, text in iter_kb_pdf_pages(full_path, content_hash, start, end))
+            if request.method == "GET":
+                # ➕ Plain text for new tab preview
+                response = Response(text, content_type="text/plain; charset=utf-8")
+            else:
+                # Else JSON (used by TTS or frontend)
+                page_count = kb_pdf_page_count(full_path, content_hash)
+                last_page = min(end, page_count) if end is not None else page_count
+                response = jsonify({
+                    "text": text,
+                    "start_page": start + 1,
+                    "end_page": last_page,
+                    "page_count": page_count,
+                    "next_cursor": str(last_page + 1) if last_page < page_count else None
+                })
+
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
 
 
 
@@ -163,6 +259,19 @@ def register_kb_routes(app):
         return jsonify({"text": text})
 
 
+    @kb_bp.route("/kb-cache-stats", methods=["GET"])
+    @jwt_required()
+    def kb_cache_stats():
+        return jsonify(get_kb_cache_stats())
+
+    @kb_bp.route("/kb-cache-admin", methods=["GET"])
+    @jwt_required()
+    def kb_cache_admin():
+        claims = get_jwt()
+        if claims.get("role") != "admin":
+            return jsonify({"error": "Unauthorized"}), 403
+        return jsonify(get_answer_cache_admin_stats())
+
     app.register_blueprint(kb_bp)
 
 
@@ -0,0 +1,151 @@
+# services/ann_index.py
+
+import json
+import math
+import os
+
+import faiss
+import numpy as np
+
+FLAT = "flat"
+HNSW = "hnsw"
+IVFPQ = "ivfpq"
+INDEX_TYPES = (FLAT, HNSW, IVFPQ)
+MANIFEST_FILE = "manifest.json"
+
+# Vector counts at which automatic selection switches index type. Flat search
+# is exact and fast enough for typical PDFs; large handbooks and merged
+# indexes move to HNSW, very large corpora to compressed IVF-PQ.
+HNSW_MIN_VECTORS = int(os.getenv("KB_HNSW_MIN_VECTORS", "20000"))
+IVFPQ_MIN_VECTORS = int(os.getenv("KB_IVFPQ_MIN_VECTORS", "200000"))
+
+# Rows added to an index per call, and rows used to train scalar quantizers
+# (their per-dimension ranges settle long before this).
+ADD_BATCH = 65536
+SQ_TRAINING_SAMPLE = 100000
+
+# Scalar quantizers for flat and HNSW indexes; IVF-PQ is already compressed.
+SCALAR_QUANTIZERS = {
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+
+def _pq_subquantizers(dim, target=64):
+    # Largest divisor of dim not above target, so each sub-vector has equal width.
+    for m in range(min(target, dim), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def choose_index_spec(count, dim, index_type=None, vector_dtype=None):
+    """
+    Index type and parameters for count vectors of width dim.
+    index_type forces a type; None or "auto" picks one by vector count.
+    vector_dtype "float16" or "int8" stores flat and HNSW vectors quantized.
+    """
+    if index_type in (None, "auto"):
+        if count >= IVFPQ_MIN_VECTORS:
+            index_type = IVFPQ
+        elif count >= HNSW_MIN_VECTORS:
+            index_type = HNSW
+        else:
+            index_type = FLAT
+
+    if vector_dtype not in (None, "float32") and vector_dtype not in SCALAR_QUANTIZERS:
+        raise ValueError(f"Unknown vector dtype: {vector_dtype}")
+    quantizer = {"quantizer": vector_dtype} if vector_dtype in SCALAR_QUANTIZERS else {}
+
+    if index_type == FLAT:
+        return {"type": FLAT, **quantizer}
+    if index_type == HNSW:
+        return {"type": HNSW, "M": 32, "ef_construction": 200, "ef_search": 64, **quantizer}
+    if index_type == IVFPQ:
+        nlist = max(1, min(int(4 * math.sqrt(count)), count // 39))
+        return {
+            "type": IVFPQ,
+            "nlist": nlist,
+            "m": _pq_subquantizers(dim),
+            "nbits": 8,
+            "nprobe": max(1, min(nlist, max(8, nlist // 16))),
+        }
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+def apply_search_params(index, spec):
+    """
+    Set query-time parameters, which FAISS does not always persist with the index.
+    """
+    if spec["type"] == HNSW:
+        index.hnsw.efSearch = spec["ef_search"]
+    elif spec["type"] == IVFPQ:
+        faiss.extract_index_ivf(index).nprobe = spec["nprobe"]
+
+
+def _training_sample(vectors, size):
+    if len(vectors) <= size:
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+    rows = np.sort(np.random.default_rng(0).choice(len(vectors), size, replace=False))
+    return np.ascontiguousarray(vectors[rows], dtype=np.float32)
+
+
+def build_index(vectors, spec, add_batch=ADD_BATCH):
+    """
+    Build an L2 FAISS index of the given spec; scores match IndexFlatL2 semantics.
+    vectors may be a memory-mapped array: training uses a sample and vectors
+    are added add_batch rows at a time, so only the index itself has to fit in memory.
+    """
+    count, dim = vectors.shape
+
+    qtype = SCALAR_QUANTIZERS.get(spec.get("quantizer"))
+
+    if spec["type"] == FLAT and qtype is not None:
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_L2)
+        index.train(_training_sample(vectors, SQ_TRAINING_SAMPLE))
+    elif spec["type"] == FLAT:
+        index = faiss.IndexFlatL2(dim)
+    elif spec["type"] == HNSW:
+        if qtype is not None:
+            index = faiss.IndexHNSWSQ(dim, qtype, spec["M"])
+            index.train(_training_sample(vectors, SQ_TRAINING_SAMPLE))
+        else:
+            index = faiss.IndexHNSWFlat(dim, spec["M"])
+        index.hnsw.efConstruction = spec["ef_construction"]
+    elif spec["type"] == IVFPQ:
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, spec["nlist"], spec["m"], spec["nbits"])
+        # Training cost grows with the sample; ~256 points per list is plenty.
+        index.train(_training_sample(vectors, spec["nlist"] * 256))
+    else:
+        raise ValueError(f"Unknown index type: {spec['type']}")
+
+    for start in range(0, count, add_batch):
+        index.add(np.ascontiguousarray(vectors[start:start + add_batch], dtype=np.float32))
+    apply_search_params(index, spec)
+    return index
+
+
+def write_manifest(store_dir, spec, count, dim, **extra):
+    manifest = {"index": spec, "count": count, "dim": dim, **extra}
+    with open(os.path.join(store_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(store_dir):
+    path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def reconstruct_all(index):
+    """
+    All stored vectors of an index (approximations for IVF-PQ and quantized indexes).
+    """
+    try:
+        faiss.extract_index_ivf(index).make_direct_map()
+    except RuntimeError:
+        pass  # not an IVF index
+    return index.reconstruct_n(0, index.ntotal)
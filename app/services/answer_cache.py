@@ -0,0 +1,66 @@
+# services/answer_cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalAnswerCache:
+    """
+    Per-worker LRU of exact-cache answers keyed by (content hash, query key),
+    in front of kb_answer_cache. Entries expire after ttl seconds so answers
+    replaced by other workers are picked up again from Mongo.
+    """
+
+    def __init__(self, maxsize=4096, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._answers = OrderedDict()  # key -> (expires_at, answer)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._answers.get(key)
+            if cached is not None and cached[0] > now:
+                self._answers.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            if cached is not None:
+                del self._answers[key]
+                self.expired += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, answer):
+        with self._lock:
+            self._answers[key] = (time.monotonic() + self.ttl, answer)
+            self._answers.move_to_end(key)
+            while len(self._answers) > self.maxsize:
+                self._answers.popitem(last=False)
+
+    def invalidate(self, content_hash):
+        """
+        Drop every answer for a PDF content hash.
+        """
+        with self._lock:
+            for key in [key for key in self._answers if key[0] == content_hash]:
+                del self._answers[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._answers),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                # Every local hit is a find_one_and_update that never reached Mongo.
+                "mongo_round_trips_saved": self.hits,
+            }
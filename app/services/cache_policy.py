@@ -0,0 +1,247 @@
+# services/cache_policy.py
+
+import threading
+import time
+from datetime import datetime
+
+from pymongo.errors import OperationFailure
+
+from services.write_behind import DUPLICATE_KEY
+
+# Set on every flushed write (see WriteBehindBuffer touch_field); the TTL
+# index and the eviction order both use it.
+LAST_USED_FIELD = "last_used_at"
+# One entry per (PDF content, canonical question); write-behind upserts rely on it.
+CACHE_KEY = [("content_hash", 1), ("query_key", 1)]
+# Mongo error codes for an index on the same keys with other options.
+INDEX_CONFLICTS = (85, 86)
+
+
+class AnswerCachePolicy:
+    """
+    Keeps kb_answer_cache bounded:
+    - at most max_per_pdf entries per content hash (0 disables), evicting the least hit
+      and then least recently used entries first;
+    - a TTL index that drops entries unused for ttl_seconds (0 disables);
+    - invalidation of every entry of a content hash no PDF has any more.
+
+    Caps are enforced on a background thread every interval seconds for the
+    content hashes that received new answers since the last pass. on_evict
+    is called with the _ids removed by cap enforcement or invalidation.
+    """
+
+    def __init__(self, collection, max_per_pdf=1000, ttl_seconds=0, interval=300, on_evict=None):
+        self.collection = collection
+        self.max_per_pdf = max_per_pdf
+        self.ttl_seconds = ttl_seconds
+        self.interval = interval
+        self.on_evict = on_evict
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._invalidate = set()
+        self._wake = threading.Event()
+        self._thread = None
+        self._indexes_ready = False
+        self.evicted_by_cap = 0
+        self.invalidated = 0
+        self.passes = 0
+        self.last_pass_at = None
+        self.last_error = None
+
+    # === Indexes ===
+    def ensure_indexes(self):
+        """
+        Create the unique cache-key index, the eviction index and the TTL
+        index, or update the TTL of an existing one.
+        """
+        self.ensure_unique_key()
+        self.collection.create_index([("content_hash", 1), ("hit_count", 1), (LAST_USED_FIELD, 1)])
+        if self.ttl_seconds > 0:
+            try:
+                self.collection.create_index(LAST_USED_FIELD, expireAfterSeconds=self.ttl_seconds)
+            except OperationFailure:
+                # Index exists with a different TTL.
+                self.collection.database.command(
+                    "collMod", self.collection.name,
+                    index={"keyPattern": {LAST_USED_FIELD: 1}, "expireAfterSeconds": self.ttl_seconds},
+                )
+        self._indexes_ready = True
+
+    def ensure_unique_key(self):
+        """
+        Make (content_hash, query_key) unique, so concurrent upserts from
+        several workers cannot insert the same entry twice. Duplicates left by
+        earlier races are merged first; a plain index on the keys is replaced.
+        """
+        for _ in range(3):
+            try:
+                self.collection.create_index(
+                    CACHE_KEY, unique=True, partialFilterExpression={"query_key": {"$exists": True}}
+                )
+                return
+            except OperationFailure as e:
+                if e.code == DUPLICATE_KEY:
+                    self.merge_duplicates()
+                elif e.code in INDEX_CONFLICTS:
+                    self.collection.drop_index(CACHE_KEY)
+                else:
+                    raise
+        raise RuntimeError("Could not create the unique answer-cache key index")
+
+    def merge_duplicates(self):
+        """
+        Keep the most hit entry of each duplicated cache key, adding the other
+        entries' hits to it, and delete the rest.
+        """
+        groups = self.collection.aggregate([
+            {"$match": {"query_key": {"$exists": True}}},
+            {"$sort": {"hit_count": -1, "_id": 1}},
+            {"$group": {
+                "_id": {"content_hash": "$content_hash", "query_key": "$query_key"},
+                "ids": {"$push": "$_id"},
+                "hits": {"$sum": "$hit_count"},
+                "count": {"$sum": 1},
+            }},
+            {"$match": {"count": {"$gt": 1}}},
+        ], allowDiskUse=True)
+        removed = []
+        for group in groups:
+            keep, drop = group["ids"][0], group["ids"][1:]
+            self.collection.update_one({"_id": keep}, {"$set": {"hit_count": group["hits"]}})
+            self.collection.delete_many({"_id": {"$in": drop}})
+            removed.extend(drop)
+        self._evicted(removed)
+        if removed:
+            print(f"🧹 Merged {len(removed)} duplicate answer-cache entries")
+        return len(removed)
+
+    def backfill_last_used(self):
+        """
+        Give entries written before last_used_at existed a value, so they can expire.
+        """
+        result = self.collection.update_many(
+            {LAST_USED_FIELD: {"$exists": False}},
+            [{"$set": {LAST_USED_FIELD: {"$ifNull": ["$updated_at", "$created_at", "$$NOW"]}}}],
+        )
+        return result.modified_count
+
+    # === Enforcement ===
+    def note_store(self, content_hash):
+        with self._lock:
+            self._dirty.add(content_hash)
+        self._ensure_thread()
+
+    def invalidate_content(self, content_hash):
+        """
+        Queue removal of all entries for a content hash that no PDF has any more.
+        """
+        with self._lock:
+            self._invalidate.add(content_hash)
+            self._dirty.discard(content_hash)
+        self._ensure_thread()
+        self._wake.set()
+
+    def _evicted(self, doc_ids):
+        if doc_ids and self.on_evict:
+            self.on_evict(doc_ids)
+
+    def enforce_cap(self, content_hash):
+        if self.max_per_pdf <= 0:
+            return 0
+        excess = self.collection.count_documents({"content_hash": content_hash}) - self.max_per_pdf
+        if excess <= 0:
+            return 0
+        victims = self.collection.find(
+            {"content_hash": content_hash}, {"_id": 1}
+        ).sort([("hit_count", 1), (LAST_USED_FIELD, 1)]).limit(excess)
+        doc_ids = [doc["_id"] for doc in victims]
+        deleted = self.collection.delete_many({"_id": {"$in": doc_ids}}).deleted_count
+        self.evicted_by_cap += deleted
+        self._evicted(doc_ids)
+        return deleted
+
+    def drop_content(self, content_hash):
+        doc_ids = [doc["_id"] for doc in self.collection.find({"content_hash": content_hash}, {"_id": 1})]
+        deleted = self.collection.delete_many({"content_hash": content_hash}).deleted_count
+        self.invalidated += deleted
+        self._evicted(doc_ids)
+        return deleted
+
+    def run_once(self, content_hashes=None):
+        """
+        One maintenance pass; content_hashes defaults to those touched since the last pass.
+        """
+        if not self._indexes_ready:
+            self.ensure_indexes()
+        with self._lock:
+            invalidate, self._invalidate = self._invalidate, set()
+            if content_hashes is None:
+                dirty, self._dirty = self._dirty, set()
+            else:
+                dirty = set(content_hashes)
+        removed = 0
+        for content_hash in invalidate:
+            removed += self.drop_content(content_hash)
+        for content_hash in dirty - invalidate:
+            removed += self.enforce_cap(content_hash)
+        self.passes += 1
+        self.last_pass_at = datetime.utcnow()
+        return removed
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="kb-cache-policy", daemon=True)
+                self._thread.start()
+
+    def start(self):
+        """
+        Start the background pass thread, which first makes sure the indexes exist.
+        """
+        self._ensure_thread()
+
+    def _run(self):
+        try:
+            self.ensure_indexes()
+        except Exception as e:
+            print(f"⚠️ Answer cache indexes not ready: {e}")
+            self.last_error = str(e)
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.run_once()
+                self.last_error = None
+            except Exception as e:
+                print(f"⚠️ Answer cache policy pass failed: {e}")
+                self.last_error = str(e)
+                time.sleep(1)
+
+    # === Reporting ===
+    def stats(self, top=20):
+        """
+        Collection size, policy settings and eviction counters, plus the PDFs with the most entries.
+        """
+        largest = self.collection.aggregate([
+            {"$group": {"_id": "$content_hash", "entries": {"$sum": 1}, "hits": {"$sum": "$hit_count"}}},
+            {"$sort": {"entries": -1}},
+            {"$limit": top},
+        ])
+        with self._lock:
+            pending = {"caps": len(self._dirty), "invalidations": len(self._invalidate)}
+        return {
+            "entries": self.collection.estimated_document_count(),
+            "max_per_pdf": self.max_per_pdf,
+            "ttl_seconds": self.ttl_seconds,
+            "evicted_by_cap": self.evicted_by_cap,
+            "invalidated": self.invalidated,
+            "pending": pending,
+            "passes": self.passes,
+            "last_pass_at": self.last_pass_at.isoformat() if self.last_pass_at else None,
+            "last_error": self.last_error,
+            "largest_pdfs": [
+                {"content_hash": doc["_id"], "entries": doc["entries"], "hits": doc["hits"]} for doc in largest
+            ],
+        }
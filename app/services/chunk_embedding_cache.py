@@ -0,0 +1,115 @@
+# services/chunk_embedding_cache.py
+
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+import numpy as np
+
+# Rows kept in the cache (0 = unbounded); past this the least recently used
+# entries are pruned down to PRUNE_TO of the cap.
+MAX_ROWS = int(os.getenv("KB_CHUNK_CACHE_MAX_ROWS", "200000"))
+PRUNE_TO = 0.9
+
+
+class ChunkEmbeddingCache:
+    """
+    Persistent cache of chunk embeddings keyed by SHA-256 of (embedding model, chunk text).
+    Re-ingesting an edited PDF only embeds the chunks whose text changed.
+    Backed by SQLite in WAL mode so several processes can share one file.
+    Holds at most max_rows entries, dropping the least recently used.
+    """
+
+    def __init__(self, db_path, model_name, max_rows=None):
+        self.db_path = db_path
+        self.model_name = model_name
+        self.max_rows = MAX_ROWS if max_rows is None else max_rows
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_embeddings ("
+                " key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vector BLOB NOT NULL,"
+                " last_used INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(chunk_embeddings)")}
+            if "last_used" not in columns:
+                # Caches created before the row cap.
+                conn.execute("ALTER TABLE chunk_embeddings ADD COLUMN last_used INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS chunk_embeddings_last_used ON chunk_embeddings (last_used)")
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.db_path, timeout=30))
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        found = {}
+        now = int(time.time())
+        with self._connect() as conn, conn:
+            # SQLite limits bound parameters per statement, so look keys up in slices.
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM chunk_embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+                if rows:
+                    hits = [key for key, _ in rows]
+                    conn.execute(
+                        f"UPDATE chunk_embeddings SET last_used = ? WHERE key IN ({','.join('?' * len(hits))})",
+                        [now, *hits],
+                    )
+        return found
+
+    def put_many(self, items):
+        now = int(time.time())
+        with self._connect() as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunk_embeddings (key, dim, vector, last_used) VALUES (?, ?, ?, ?)",
+                [
+                    (key, len(vector), np.asarray(vector, dtype=np.float32).tobytes(), now)
+                    for key, vector in items
+                ],
+            )
+            if self.max_rows:
+                self._prune(conn)
+
+    def _prune(self, conn):
+        (rows,) = conn.execute("SELECT COUNT(*) FROM chunk_embeddings").fetchone()
+        if rows <= self.max_rows:
+            return
+        conn.execute(
+            "DELETE FROM chunk_embeddings WHERE key IN"
+            " (SELECT key FROM chunk_embeddings ORDER BY last_used LIMIT ?)",
+            (rows - int(self.max_rows * PRUNE_TO),),
+        )
+
+    def embed_documents(self, texts, embeddings, batch_size=64):
+        """
+        Return one float32 vector per text, calling embeddings.embed_documents
+        only for texts that are not cached yet. Also returns the number of cache hits.
+        """
+        keys = [self.key(text) for text in texts]
+        cached = self.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        missing_items = list(missing.items())
+        for start in range(0, len(missing_items), batch_size):
+            batch = missing_items[start:start + batch_size]
+            vectors = embeddings.embed_documents([text for _, text in batch])
+            new_items = [(key, np.asarray(vector, dtype=np.float32)) for (key, _), vector in zip(batch, vectors)]
+            self.put_many(new_items)
+            cached.update(new_items)
+
+        return [cached[key] for key in keys], len(texts) - len(missing)
+
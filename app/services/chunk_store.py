@@ -0,0 +1,254 @@
+# services/chunk_store.py
+
+import json
+import os
+import sqlite3
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from services.ann_index import apply_search_params, build_index, choose_index_spec, read_manifest, write_manifest
+from services.lexical_index import LexicalIndex, LexicalIndexBuilder, has_lexical_index, reciprocal_rank_fusion
+from services.vector_codec import EMBED_DIM, VECTOR_DTYPE, match_dims, reduce_dims
+
+CHUNK_STORE_FILE = "chunks.sqlite"
+INDEX_FILE = "index.faiss"
+SPILL_FILE = "vectors.spill"
+
+# Vectors a ChunkStoreWriter keeps in memory before appending them to its spill file.
+INGEST_MEMORY_MB = float(os.getenv("KB_INGEST_MEMORY_MB", "256"))
+
+
+def read_chunks(store_dir, positions=None):
+    """
+    Documents at the given FAISS positions (all documents if positions is None), in that order.
+    """
+    uri = f"file:{os.path.join(store_dir, CHUNK_STORE_FILE)}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True)
+    try:
+        if positions is None:
+            rows = conn.execute("SELECT pos, text, metadata FROM chunks ORDER BY pos").fetchall()
+            positions = [row[0] for row in rows]
+        else:
+            placeholders = ",".join("?" * len(positions))
+            rows = conn.execute(
+                f"SELECT pos, text, metadata FROM chunks WHERE pos IN ({placeholders})", positions
+            ).fetchall()
+    finally:
+        conn.close()
+    by_pos = {pos: Document(page_content=text, metadata=json.loads(metadata)) for pos, text, metadata in rows}
+    return [by_pos[pos] for pos in positions if pos in by_pos]
+
+
+def save_chunk_store_index(store_dir, vectors, docs, index_type=None, embed_dim=None, vector_dtype=None, **manifest_extra):
+    """
+    Build and persist a FAISS index over vectors plus its chunk store, where
+    docs[i] belongs to vectors[i]. The index type is chosen by vector count
+    unless index_type forces one; type and parameters go to manifest.json.
+    Vectors are truncated to embed_dim and stored as vector_dtype, both
+    defaulting to KB_EMBED_DIM / KB_VECTOR_DTYPE.
+    """
+    writer = ChunkStoreWriter(store_dir, embed_dim=embed_dim)
+    try:
+        writer.add(docs, vectors)
+        return writer.finish(index_type, vector_dtype, **manifest_extra)
+    finally:
+        writer.close()
+
+
+class ChunkStoreWriter:
+    """
+    Builds a chunk store batch by batch. Chunks go straight to chunks.sqlite
+    and into the postings of its BM25 index; vectors are truncated per batch and held in memory up to memory_mb, past
+    which they are appended to a spill file in store_dir. finish() picks the
+    index type for the final count and adds the vectors to it in slices, from
+    memory or from the memory-mapped spill file.
+    """
+
+    def __init__(self, store_dir, embed_dim=None, memory_mb=None):
+        self.store_dir = store_dir
+        self.embed_dim = EMBED_DIM if embed_dim is None else embed_dim
+        self.memory_bytes = (INGEST_MEMORY_MB if memory_mb is None else memory_mb) * 1024 * 1024
+        self.count = 0
+        self.dim = None
+        self.source_dim = None
+        self.spilled = 0
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._spill = None
+        self._conn = sqlite3.connect(os.path.join(store_dir, CHUNK_STORE_FILE))
+        # A rerun into the same dir (e.g. after a crash) starts from an empty table.
+        self._conn.execute("DROP TABLE IF EXISTS chunks")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chunks (pos INTEGER PRIMARY KEY, text TEXT NOT NULL, metadata TEXT NOT NULL)")
+        self._chunks = 0
+        self._lexical = LexicalIndexBuilder()
+
+    def add_chunks(self, docs):
+        start = self._chunks
+        self._conn.executemany(
+            "INSERT INTO chunks (pos, text, metadata) VALUES (?, ?, ?)",
+            [(start + i, doc.page_content, json.dumps(doc.metadata, default=str)) for i, doc in enumerate(docs)],
+        )
+        self._conn.commit()
+        for doc in docs:
+            self._lexical.add(doc.page_content)
+        self._chunks += len(docs)
+
+    def add_vectors(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(vectors):
+            return
+        if self.source_dim is None:
+            self.source_dim = vectors.shape[1]
+        vectors = np.ascontiguousarray(reduce_dims(vectors, self.embed_dim), dtype=np.float32)
+        self.dim = vectors.shape[1]
+        self.count += len(vectors)
+        self._buffer.append(vectors)
+        self._buffered_bytes += vectors.nbytes
+        if self._buffered_bytes > self.memory_bytes:
+            self._flush_spill()
+
+    def add(self, docs, vectors):
+        """
+        Append a batch of chunks and their vectors; docs[i] belongs to vectors[i].
+        """
+        if len(docs) != len(vectors):
+            raise ValueError(f"{len(docs)} chunks but {len(vectors)} vectors")
+        self.add_chunks(docs)
+        self.add_vectors(vectors)
+
+    def _flush_spill(self):
+        if self._spill is None:
+            self._spill = open(os.path.join(self.store_dir, SPILL_FILE), "wb")
+        for vectors in self._buffer:
+            self._spill.write(vectors.tobytes())
+        self.spilled += sum(len(vectors) for vectors in self._buffer)
+        self._buffer, self._buffered_bytes = [], 0
+
+    def _vectors(self):
+        if self._spill is None:
+            return np.vstack(self._buffer)
+        self._flush_spill()
+        self._spill.close()
+        return np.memmap(os.path.join(self.store_dir, SPILL_FILE), dtype=np.float32, mode="r", shape=(self.count, self.dim))
+
+    def finish(self, index_type=None, vector_dtype=None, **manifest_extra):
+        """
+        Write index.faiss, the BM25 tables and manifest.json; returns the index spec.
+        """
+        if self.count != self._chunks:
+            raise ValueError(f"{self._chunks} chunks but {self.count} vectors")
+        if not self.count:
+            raise ValueError("No chunks to index")
+        vectors = self._vectors()
+        spec = choose_index_spec(self.count, self.dim, index_type, vector_dtype or VECTOR_DTYPE)
+        faiss.write_index(build_index(vectors, spec), os.path.join(self.store_dir, INDEX_FILE))
+        del vectors
+        self._lexical.write(self._conn)
+        if self.dim != self.source_dim:
+            manifest_extra["truncated_from"] = self.source_dim
+        write_manifest(self.store_dir, spec, self.count, self.dim, lexical_index="bm25", **manifest_extra)
+        return spec
+
+    def close(self):
+        self._conn.close()
+        self._buffer = []
+        self._lexical = None
+        if self._spill is not None:
+            self._spill.close()
+            os.remove(os.path.join(self.store_dir, SPILL_FILE))
+            self._spill = None
+
+
+def has_chunk_store(store_dir):
+    return os.path.isfile(os.path.join(store_dir, CHUNK_STORE_FILE))
+
+
+def add_lexical_index(store_dir):
+    """
+    Build the BM25 tables of a chunk store written before they existed.
+    Returns False if the store already has them.
+    """
+    conn = sqlite3.connect(os.path.join(store_dir, CHUNK_STORE_FILE), timeout=30)
+    try:
+        if has_lexical_index(conn):
+            return False
+        builder = LexicalIndexBuilder()
+        for (text,) in conn.execute("SELECT text FROM chunks ORDER BY pos"):
+            builder.add(text)
+        builder.write(conn)
+        return True
+    finally:
+        conn.close()
+
+
+class ChunkStoreIndex(VectorStore):
+    """
+    Vector store over index.faiss + chunks.sqlite, written once by
+    save_chunk_store_index (or from_texts) and searched only. Loading it reads only
+    the vectors; chunk texts are fetched by position after each search, so memory
+    scales with k rather than with the document and nothing is unpickled.
+    Stores with BM25 tables also support hybrid_search_by_vector.
+    """
+
+    def __init__(self, store_dir, embedding):
+        self.store_dir = store_dir
+        self.embedding = embedding
+        self.index = faiss.read_index(os.path.join(store_dir, INDEX_FILE))
+        self.manifest = read_manifest(store_dir)
+        if self.manifest:
+            apply_search_params(self.index, self.manifest["index"])
+        self.lexical = LexicalIndex.open(os.path.join(store_dir, CHUNK_STORE_FILE))
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        # Stores built with truncated vectors are searched with an equally truncated query.
+        query = match_dims(embedding, self.index.d)[None, :]
+        distances, positions = self.index.search(query, k)
+        hits = [(int(pos), float(dist)) for pos, dist in zip(positions[0], distances[0]) if pos != -1]
+        docs = read_chunks(self.store_dir, [pos for pos, _ in hits])
+        return list(zip(docs, [dist for _, dist in hits]))
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k)]
+
+    def _dense_positions(self, embedding, k):
+        _, positions = self.index.search(match_dims(embedding, self.index.d)[None, :], k)
+        return [int(pos) for pos in positions[0] if pos != -1]
+
+    def hybrid_search_by_vector(self, query, embedding, k=4, fetch_k=20):
+        """
+        Fuse the fetch_k best dense and BM25 matches by reciprocal rank and
+        return the top k chunks. Exact terms (names, numbers) the embedding
+        misses still rank high, so a small k suffices. Falls back to dense
+        search for stores without a lexical index.
+        """
+        if self.lexical is None:
+            return self.similarity_search_by_vector(embedding, k=k)
+        dense = self._dense_positions(embedding, max(k, fetch_k))
+        lexical = [pos for pos, _ in self.lexical.search(query, max(k, fetch_k))]
+        return read_chunks(self.store_dir, reciprocal_rank_fusion(dense, lexical)[:k])
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding.embed_query(query), k=k)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, store_dir=None, **kwargs):
+        """
+        Embed texts, write them as a chunk store in store_dir and open it.
+        Other keyword arguments (index_type, embed_dim, ...) go to save_chunk_store_index.
+        """
+        if store_dir is None:
+            raise ValueError("ChunkStoreIndex.from_texts needs a store_dir to write the chunk store to")
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        docs = [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)]
+        vectors = embedding.embed_documents(texts)
+        os.makedirs(store_dir, exist_ok=True)
+        save_chunk_store_index(store_dir, vectors, docs, **kwargs)
+        return cls(store_dir, embedding)
@@ -0,0 +1,127 @@
+# services/context_packing.py
+
+from langchain_core.documents import Document
+
+# Shortest suffix/prefix match treated as splitter overlap rather than coincidence.
+MIN_OVERLAP_CHARS = 20
+# A passage cut to fit the budget must keep at least this many tokens.
+MIN_TRUNCATED_TOKENS = 64
+SEPARATOR = "\n\n"
+
+
+def estimate_tokens(text):
+    """
+    Rough token count (~4 characters per token for English text with
+    Llama-style tokenizers); good enough for budgeting and logging.
+    """
+    return (len(text) + 3) // 4
+
+
+def overlap_length(before, after, min_overlap=MIN_OVERLAP_CHARS):
+    """
+    Length of the longest suffix of before that is also a prefix of after,
+    or 0 if it is shorter than min_overlap.
+    """
+    if len(after) < min_overlap:
+        return 0
+    head = after[:min_overlap]
+    best = 0
+    start = before.find(head)
+    while start != -1:
+        if after.startswith(before[start:]):
+            best = len(before) - start
+            break  # earliest match is the longest suffix
+        start = before.find(head, start + 1)
+    return best
+
+
+def _merge_group(passages):
+    """
+    Merge passages of one page: drop repeats and contained chunks, then join
+    chunks whose end overlaps another's start, keeping the better rank.
+    """
+    merged = []
+    for passage in passages:
+        if any(passage["text"] in other["text"] for other in merged):
+            continue
+        merged = [other for other in merged if other["text"] not in passage["text"]] + [passage]
+
+    joined = True
+    while joined:
+        joined = False
+        for a in merged:
+            for b in merged:
+                if a is b:
+                    continue
+                overlap = overlap_length(a["text"], b["text"])
+                if overlap:
+                    a["text"] += b["text"][overlap:]
+                    a["rank"] = min(a["rank"], b["rank"])
+                    a["chunks"] += b["chunks"]
+                    merged.remove(b)
+                    joined = True
+                    break
+            if joined:
+                break
+    return merged
+
+
+def _truncate(text, tokens):
+    cut = text[:tokens * 4]
+    # End on a sentence, or failing that a word, boundary.
+    boundary = max(cut.rfind(". "), cut.rfind("\n"))
+    if boundary < len(cut) // 2:
+        boundary = cut.rfind(" ")
+    return cut[:boundary + 1].rstrip() if boundary > 0 else cut
+
+
+def pack_context(docs, budget_tokens):
+    """
+    Turn retrieved chunks (best first) into the documents to stuff into the
+    prompt: overlapping text between neighbouring chunks of a page is sent
+    once, neighbours are merged into one passage, and passages are taken in
+    rank order until budget_tokens of context are used (the last one cut at
+    a sentence boundary if enough room is left). Passages keep document
+    order. Returns (documents, stats).
+    """
+    groups = {}
+    for rank, doc in enumerate(docs):
+        key = (str(doc.metadata.get("source", "")), _page(doc.metadata))
+        groups.setdefault(key, []).append(
+            {"text": doc.page_content, "rank": rank, "chunks": 1, "key": key, "metadata": doc.metadata}
+        )
+    passages = [passage for group in groups.values() for passage in _merge_group(group)]
+
+    packed, used = [], 0
+    separator_tokens = estimate_tokens(SEPARATOR)
+    for passage in sorted(passages, key=lambda p: p["rank"]):
+        separator = separator_tokens if packed else 0
+        room = budget_tokens - used - separator
+        tokens = estimate_tokens(passage["text"])
+        if tokens <= room:
+            packed.append(passage)
+            used += separator + tokens
+        elif room >= MIN_TRUNCATED_TOKENS:
+            passage["text"] = _truncate(passage["text"], room)
+            packed.append(passage)
+            used += separator + estimate_tokens(passage["text"])
+            break
+        # Otherwise skip it; a shorter, lower-ranked passage may still fit.
+
+    packed.sort(key=lambda p: (p["key"], p["rank"]))
+    stats = {
+        "chunks": len(docs),
+        "passages": len(packed),
+        "merged": sum(p["chunks"] - 1 for p in passages),
+        "context_tokens": used,
+        "unpacked_tokens": estimate_tokens(SEPARATOR.join(doc.page_content for doc in docs)),
+        "budget_tokens": budget_tokens,
+    }
+    return [Document(page_content=p["text"], metadata=p["metadata"]) for p in packed], stats
+
+
+def _page(metadata):
+    try:
+        return int(metadata.get("page", 0))
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,80 @@
+# services/embedding_cache.py
+
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_query_text(text):
+    """
+    Fold case and whitespace so trivially different spellings of a question
+    share one embedding.
+    """
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def canonical_query_key(text):
+    """
+    Exact answer-cache key: case, whitespace and punctuation folded, so
+    "What is an integer?" and "what is an integer ?" are the same question.
+    Punctuation between letters or digits ("2.5", "3-4", "don't") and a
+    dash before a number ("-3", "3 - 4") are kept, since they change the question.
+    """
+    chars = []
+    for i, ch in enumerate(text):
+        category = unicodedata.category(ch)
+        if category.startswith("P"):
+            before = text[i - 1] if i else ""
+            after = text[i + 1] if i + 1 < len(text) else ""
+            kept = (before.isalnum() and after.isalnum()) or (
+                category == "Pd" and text[i + 1:].lstrip()[:1].isdigit()
+            )
+            if not kept:
+                ch = " "
+        chars.append(ch)
+    return normalize_query_text("".join(chars))
+
+
+class QueryEmbeddingCache:
+    """
+    LRU of query embeddings keyed by (embedding model, normalized query text),
+    so repeated questions skip the round trip to the embedding server.
+    """
+
+    def __init__(self, embeddings, model_name, maxsize=4096):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._vectors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def embed_query(self, text):
+        key = (self.model_name, normalize_query_text(text))
+        with self._lock:
+            vector = self._vectors.get(key)
+            if vector is not None:
+                self._vectors.move_to_end(key)
+                self.hits += 1
+                return vector
+            self.misses += 1
+
+        vector = self.embeddings.embed_query(text)
+
+        with self._lock:
+            self._vectors[key] = vector
+            self._vectors.move_to_end(key)
+            while len(self._vectors) > self.maxsize:
+                self._vectors.popitem(last=False)
+        return vector
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._vectors),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,77 @@
+# services/file_lock.py
+
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines: locks degrade to no-ops
+    fcntl = None
+
+
+class FileLock:
+    """
+    Advisory cross-process lock backed by flock() on a lock file.
+    Shared by every gunicorn worker on the same host or volume.
+    With remove_on_release the file is deleted on release, for locks on
+    short-lived keys; a waiter that locked the deleted file retries on the
+    file now at path.
+    """
+
+    def __init__(self, path, poll_interval=0.05, remove_on_release=False):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.remove_on_release = remove_on_release
+        self._fd = None
+
+    def acquire(self, blocking=True, timeout=None):
+        """
+        Try to take the lock. Returns False if it is held elsewhere and either
+        blocking is False or timeout seconds passed.
+        """
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if self.remove_on_release and not self._is_current(fd):
+                    # The holder deleted this file on release; lock the one now at path.
+                    os.close(fd)
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                    continue
+                self._fd = fd
+                return True
+            except BlockingIOError:
+                if not blocking or (deadline is not None and time.monotonic() >= deadline):
+                    os.close(fd)
+                    return False
+                time.sleep(self.poll_interval)
+
+    def _is_current(self, fd):
+        try:
+            return os.fstat(fd).st_ino == os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def release(self):
+        if self._fd is None:
+            return
+        if self.remove_on_release:
+            # Deleted while still locked, so nobody can lock it and then find it gone unnoticed.
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
@@ -0,0 +1,127 @@
+# services/ingest_jobs.py
+
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+
+class IngestJobQueue:
+    """
+    Background pool that builds vector stores outside the request path.
+    Job state lives in Mongo so every gunicorn worker can report on jobs
+    started by another worker. Running jobs are heartbeated every
+    heartbeat_interval; a job that stopped updating for stale_after (e.g. its
+    worker was killed) no longer counts as active. A store whose last build
+    failed less than retry_after ago is reported by find_recent_failure, so
+    callers can back off instead of rebuilding on every request.
+    """
+
+    def __init__(self, collection, max_workers=2, stale_after=timedelta(minutes=5), heartbeat_interval=30,
+                 retry_after=timedelta(minutes=5)):
+        self.collection = collection
+        self.stale_after = stale_after
+        self.retry_after = retry_after
+        self.heartbeat_interval = heartbeat_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="kb-ingest")
+        self._lock = threading.Lock()
+        self._active = {}  # store_key -> job_id, for jobs running in this worker
+        self._running = set()
+        self._heartbeat = None
+
+    def find_active(self, store_key):
+        with self._lock:
+            job_id = self._active.get(store_key)
+        if job_id:
+            return self.get(job_id)
+        return self.collection.find_one({
+            "store_key": store_key,
+            "status": {"$in": list(ACTIVE_STATUSES)},
+            "updated_at": {"$gte": datetime.utcnow() - self.stale_after},
+        })
+
+    def find_recent_failure(self, store_key):
+        """
+        The latest job for store_key if it failed within retry_after, else None.
+        """
+        job = self.collection.find_one({"store_key": store_key}, sort=[("created_at", -1)])
+        if job and job["status"] == FAILED and job.get("finished_at", job["updated_at"]) >= datetime.utcnow() - self.retry_after:
+            return job
+        return None
+
+    def submit(self, store_key, pdf_path, build):
+        """
+        Queue build(progress) for store_key unless a job for it is already active.
+        build reports progress by calling progress(dict), which is stored on the job.
+        Returns the id of the queued or already active job.
+        """
+        active = self.find_active(store_key)
+        if active:
+            return active["_id"]
+
+        job_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        self.collection.insert_one({
+            "_id": job_id,
+            "store_key": store_key,
+            "pdf_path": pdf_path,
+            "status": QUEUED,
+            "created_at": now,
+            "updated_at": now,
+        })
+        with self._lock:
+            self._active[store_key] = job_id
+        self._executor.submit(self._run, job_id, store_key, build)
+        print(f"🧾 Queued ingest job {job_id} for {pdf_path}")
+        return job_id
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = datetime.utcnow()
+        self.collection.update_one({"_id": job_id}, {"$set": fields})
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                self.collection.update_many({"_id": {"$in": running}}, {"$set": {"updated_at": datetime.utcnow()}})
+            except Exception as e:
+                print(f"⚠️ Ingest job heartbeat failed: {e}")
+
+    def _ensure_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name="kb-ingest-heartbeat", daemon=True)
+                self._heartbeat.start()
+
+    def _run(self, job_id, store_key, build):
+        self.update(job_id, status=RUNNING, started_at=datetime.utcnow())
+        with self._lock:
+            self._running.add(job_id)
+        self._ensure_heartbeat()
+        try:
+            build(lambda progress: self.update(job_id, progress=progress))
+            self.update(job_id, status=DONE, finished_at=datetime.utcnow())
+            print(f"✅ Ingest job {job_id} finished")
+        except Exception as e:
+            traceback.print_exc()
+            self.update(job_id, status=FAILED, error=str(e), finished_at=datetime.utcnow())
+            print(f"❌ Ingest job {job_id} failed: {e}")
+        finally:
+            with self._lock:
+                self._active.pop(store_key, None)
+                self._running.discard(job_id)
+
+    def get(self, job_id):
+        return self.collection.find_one({"_id": job_id})
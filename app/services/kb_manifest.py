@@ -0,0 +1,139 @@
+# services/kb_manifest.py
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def _join(rel, name):
+    return f"{rel}/{name}" if rel else name
+
+
+class KBManifest:
+    """
+    In-memory listing of every directory under the KB root: subdirectories
+    and PDF files, keyed by '/'-separated path relative to the root ('' is the
+    root itself). A directory's mtime changes whenever an entry is added,
+    removed or renamed in it, so revalidation stats each known directory at
+    most every check_interval seconds and re-lists only the changed ones.
+    """
+
+    def __init__(self, root, check_interval=2.0):
+        self.root = root
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._dirs = {}  # rel -> {"mtime_ns", "dirs", "pdfs"}
+        self._checked_at = 0.0
+        self._digest = None
+        self.rescans = 0
+
+    def _path(self, rel):
+        return os.path.join(self.root, *rel.split("/")) if rel else self.root
+
+    def _scan(self, rel):
+        path = self._path(rel)
+        mtime_ns = os.stat(path).st_mtime_ns
+        dirs, pdfs = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.name.endswith(".pdf") and entry.is_file():
+                    pdfs.append(entry.name)
+        self.rescans += 1
+        return {"mtime_ns": mtime_ns, "dirs": sorted(dirs), "pdfs": sorted(pdfs)}
+
+    def _rescan(self, rel):
+        old = self._dirs.get(rel)
+        entry = self._dirs[rel] = self._scan(rel)
+        for name in old["dirs"] if old else ():
+            if name not in entry["dirs"]:
+                self._drop(_join(rel, name))
+        for name in entry["dirs"]:
+            if _join(rel, name) not in self._dirs:
+                self._rescan(_join(rel, name))
+
+    def _drop(self, rel):
+        prefix = rel + "/"
+        for key in [key for key in self._dirs if key == rel or key.startswith(prefix)]:
+            del self._dirs[key]
+
+    def refresh(self, force=False):
+        """
+        Re-list directories whose mtime changed since they were listed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._dirs and not force and now - self._checked_at < self.check_interval:
+                return
+            if not self._dirs:
+                self._rescan("")
+                self._digest = None
+            for rel in sorted(self._dirs):
+                entry = self._dirs.get(rel)
+                if entry is None:
+                    continue  # dropped together with a changed parent
+                try:
+                    mtime_ns = os.stat(self._path(rel)).st_mtime_ns
+                except FileNotFoundError:
+                    self._drop(rel)
+                    self._digest = None
+                    continue
+                if mtime_ns != entry["mtime_ns"]:
+                    self._rescan(rel)
+                    self._digest = None
+            self._checked_at = now
+
+    def listing(self, rel=""):
+        """
+        {"dirs": [...], "pdfs": [...]} of a directory, or None if it does not exist.
+        """
+        self.refresh()
+        with self._lock:
+            entry = self._dirs.get(rel.strip("/"))
+            return {"dirs": list(entry["dirs"]), "pdfs": list(entry["pdfs"])} if entry else None
+
+    def add_pdf(self, rel_dir, filename):
+        """
+        Record a PDF just written to rel_dir without re-listing the tree.
+        """
+        with self._lock:
+            if not self._dirs:
+                return  # first refresh lists everything anyway
+            parts = rel_dir.strip("/").split("/")
+            for depth in range(len(parts)):
+                parent, name = "/".join(parts[:depth]), parts[depth]
+                entry = self._dirs.get(parent)
+                if entry is not None and name not in entry["dirs"]:
+                    self._rescan(parent)
+                    break
+            entry = self._dirs.get("/".join(parts))
+            if entry is not None:
+                if filename not in entry["pdfs"]:
+                    entry["pdfs"] = sorted(entry["pdfs"] + [filename])
+                entry["mtime_ns"] = os.stat(self._path("/".join(parts))).st_mtime_ns
+            self._digest = None
+
+    def etag(self, *variant):
+        """
+        Validator for a listing derived from the manifest; variant holds whatever
+        else shapes the response (ACL, requested folder). Identical trees give
+        identical ETags in every worker.
+        """
+        self.refresh()
+        with self._lock:
+            if self._digest is None:
+                tree = {rel: [entry["dirs"], entry["pdfs"]] for rel, entry in self._dirs.items()}
+                self._digest = hashlib.sha1(json.dumps(tree, sort_keys=True).encode("utf-8")).hexdigest()
+            digest = self._digest
+        return hashlib.sha1(json.dumps([digest, variant], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "directories": len(self._dirs),
+                "pdfs": sum(len(entry["pdfs"]) for entry in self._dirs.values()),
+                "rescans": self.rescans,
+            }
@@ -1,129 +1,253 @@
 # services/kb_service.py
 
+import atexit
 import hashlib
+import json
 import os
+import re
+import threading
 
 import certifi
 from flask import jsonify
-from datetime import datetime
-from pymongo import MongoClient
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from langchain_community.vectorstores import FAISS
 from langchain_ollama.embeddings import OllamaEmbeddings
 from langchain_community.llms import Ollama
-from langchain_community.document_loaders import PyPDFLoader
 from langchain.chains.question_answering import load_qa_chain
+from langchain.chains.question_answering.stuff_prompt import PROMPT as STUFF_PROMPT
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from services.llm_config import LLM_MODELS
+from services.llm_config import LLM_CONTEXT_TOKENS, LLM_MODELS
+from services.pg13_guard import is_safe_text
+from services.answer_cache import LocalAnswerCache
+from services.cache_policy import LAST_USED_FIELD, AnswerCachePolicy
+from services.chunk_embedding_cache import ChunkEmbeddingCache
+from services.context_packing import SEPARATOR, estimate_tokens, pack_context
+from services.ann_index import read_manifest
+from services.chunk_store import ChunkStoreIndex, add_lexical_index, has_chunk_store, save_chunk_store_index
+from services.embedding_cache import QueryEmbeddingCache, canonical_query_key
+from services.ingest_jobs import IngestJobQueue
+from services.kb_manifest import KBManifest
+from services.page_text_store import PageTextStore
+from services.pdf_parser import iter_page_documents, load_pages, page_count as pdf_page_count, resolve_backend
+from services.semantic_cache_index import SemanticCacheIndex
+from services.single_flight import SingleFlight
+from services.streaming_ingest import ingest_pages
+from services.vector_bundle import VectorBundle, read_faiss_store
+from services.vector_codec import CACHE_EMBED_DTYPE, EMBED_DIM, is_packed_embedding, pack_embedding, reduce_dims, unpack_embedding
+from services.vector_store_cache import VectorStoreCache
+from services.vector_store_files import build_store_atomically, is_complete_store, wait_for_store
+from services.write_behind import DUPLICATE_KEY, WriteBehindBuffer
 
 # === Paths ===
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 KB_ROOT = os.path.join(BASE_DIR, "kb")
 VECTOR_STORE_DIR = os.path.join(BASE_DIR, "vector_stores")
+LOCK_DIR = os.getenv("KB_LOCK_DIR", os.path.join(VECTOR_STORE_DIR, ".locks"))
+# "auto" picks flat / HNSW / IVF-PQ by vector count; see services/ann_index.py.
+INDEX_TYPE = os.getenv("KB_INDEX_TYPE", "auto")
+# Chunks stuffed into the prompt: dense-only stores need a wider net than
+# hybrid BM25 + dense retrieval, which finds exact terms at a smaller k.
+RETRIEVAL_K = int(os.getenv("KB_RETRIEVAL_K", "4"))
+HYBRID_K = int(os.getenv("KB_HYBRID_K", "3"))
+HYBRID_FETCH_K = int(os.getenv("KB_HYBRID_FETCH_K", "20"))
+VECTOR_BUNDLE_PATH = os.getenv("KB_VECTOR_BUNDLE", os.path.join(VECTOR_STORE_DIR, ".bundle", "vector_stores.kbpack"))
 os.makedirs(KB_ROOT, exist_ok=True)
 os.makedirs(VECTOR_STORE_DIR, exist_ok=True)
 
 # === Embedding & Mongo Setup ===
 model = LLM_MODELS["ask_kb"]
 print(f"🔍 Using model for Ask KB: {model}")
+CONTEXT_TOKENS = LLM_CONTEXT_TOKENS["ask_kb"]
 base_url = os.getenv("BASE_URL")
 mongodb_url = os.getenv("MONGODB_URL")
-embedding_model = OllamaEmbeddings(model="nomic-embed-text",base_url= base_url)
+EMBEDDING_MODEL_NAME = "nomic-embed-text"
+embedding_model = OllamaEmbeddings(model=EMBEDDING_MODEL_NAME,base_url= base_url)
+query_embeddings = QueryEmbeddingCache(
+    embedding_model,
+    EMBEDDING_MODEL_NAME,
+    maxsize=int(os.getenv("KB_QUERY_EMBED_CACHE_SIZE", "4096")),
+)
+# Parsed page text per PDF content hash, shared by reading, previews and ingestion.
+page_texts = PageTextStore(os.path.join(VECTOR_STORE_DIR, ".page_text", "pages.sqlite"))
+chunk_embeddings = ChunkEmbeddingCache(os.path.join(VECTOR_STORE_DIR, ".chunk_cache", "embeddings.sqlite"), EMBEDDING_MODEL_NAME)
 client = MongoClient(mongodb_url,
     tls=True,
     tlsCAFile=certifi.where()
 )
 db = client["gowowschat_db"]
 cache_col = db["kb_answer_cache"]
+alias_col = db["kb_path_aliases"]
+
+# === Background ingestion ===
+# Running jobs heartbeat every 30s; a job silent for KB_INGEST_STALE_SECONDS
+# (its worker died) stops blocking a new build of the same store.
+ingest_jobs = IngestJobQueue(
+    db["kb_ingest_jobs"],
+    max_workers=int(os.getenv("KB_INGEST_WORKERS", "2")),
+    stale_after=timedelta(seconds=int(os.getenv("KB_INGEST_STALE_SECONDS", "300"))),
+    retry_after=timedelta(seconds=int(os.getenv("KB_INGEST_RETRY_SECONDS", "300"))),
+)
+
+
+class IndexingInProgress(Exception):
+    """Raised when a question targets a PDF whose vector store is still being built."""
+
+    def __init__(self, job_id):
+        super().__init__("Indexing in progress, please try again shortly")
+        self.job_id = job_id
+
+
+class IndexingFailed(Exception):
+    """Raised when the last build of a PDF's vector store failed less than KB_INGEST_RETRY_SECONDS ago."""
 
+    def __init__(self, job):
+        super().__init__(f"Indexing this PDF failed: {job.get('error', 'unknown error')}")
+        self.job_id = job["_id"]
 
-# === Cosine Similarity ===
-def cosine_similarity(vec1, vec2):
-    dot = sum(x * y for x, y in zip(vec1, vec2))
-    norm1 = sum(x * x for x in vec1) ** 0.5
-    norm2 = sum(y * y for y in vec2) ** 0.5
-    return dot / (norm1 * norm2)
+
+# Seconds a request polls for an in-flight vector store build before answering "indexing".
+BUILD_WAIT_SECONDS = float(os.getenv("KB_BUILD_WAIT_SECONDS", "2"))
+
+# === Coalescing of identical concurrent questions ===
+ask_flights = SingleFlight(lock_dir=LOCK_DIR, wait_timeout=int(os.getenv("KB_SINGLE_FLIGHT_TIMEOUT", "300")))
+
+# === Loaded Vector Store Cache ===
+vector_store_cache = VectorStoreCache(
+    max_entries=int(os.getenv("KB_VECTOR_CACHE_MAX_ENTRIES", "32")),
+    max_bytes=int(os.getenv("KB_VECTOR_CACHE_MAX_MB", "1024")) * 1024 * 1024,
+)
+
+
+# One ANN index over all cached questions, filtered by content hash; saved
+# periodically so restarted workers only catch up on newer entries.
+semantic_index = SemanticCacheIndex(
+    cache_col,
+    dim=EMBED_DIM,
+    path=os.path.join(VECTOR_STORE_DIR, ".semantic_cache", "index.npz"),
+    save_interval=int(os.getenv("KB_SEMANTIC_SAVE_SECONDS", "300")),
+)
+atexit.register(semantic_index.save)
 
 
 # === Semantic Match with Cached Embeddings ===
-def get_semantic_match(pdf_path, query, threshold=0.9):
-    all_docs = list(cache_col.find({"pdf_path": pdf_path, "embedding": {"$exists": True}}))
-    if not all_docs:
+def get_semantic_match(content_hash, query_vector, threshold=0.9):
+    if not semantic_index.refresh(content_hash):
         return None
 
-    query_vector = embedding_model.embed_query(query)
-    best_match = None
-    best_score = -1
-
-    for doc in all_docs:
-        doc_vector = doc.get("embedding", [])
-        if not doc_vector: continue
-        score = cosine_similarity(query_vector, doc_vector)
-        if score > best_score:
-            best_score = score
-            best_match = doc["answer"]
+    doc_id, best_score = semantic_index.best_match(content_hash, query_vector)
+    if doc_id is None or best_score < threshold:
+        return None
 
-    return best_match + " (From Semantic Cache)" if best_score >= threshold else None
+    doc = cache_col.find_one({"_id": doc_id}, {"answer": 1})
+    if not doc:
+        # Deleted since the index last caught up; drop it so it stops winning.
+        semantic_index.remove([doc_id])
+        return None
+    return doc["answer"] + " (From Semantic Cache)"
 
 
 # === Cache Ops ===
-def get_cached_answer(pdf_path, query):
-    doc = cache_col.find_one_and_update(
-        {"pdf_path": pdf_path, "query": query},
-        {"$inc": {"hit_count": 1}},
-        return_document=True
+# Cache entries are keyed by the SHA-256 of the PDF content, so renamed or
+# duplicated PDFs share answers and replaced content never serves stale ones.
+# Within a PDF the key is the canonical query key (case, whitespace and
+# punctuation folded); exact hits are served from a per-worker LRU first.
+local_answers = LocalAnswerCache(
+    maxsize=int(os.getenv("KB_ANSWER_CACHE_SIZE", "4096")),
+    ttl=int(os.getenv("KB_ANSWER_CACHE_TTL", "300")),
+)
+# hit_count increments and new answers reach Mongo in periodic bulk writes;
+# whatever is still buffered is flushed on shutdown.
+cache_writes = WriteBehindBuffer(
+    cache_col,
+    flush_interval=float(os.getenv("KB_CACHE_FLUSH_SECONDS", "1")),
+    max_pending=int(os.getenv("KB_CACHE_FLUSH_MAX_PENDING", "500")),
+    touch_field=LAST_USED_FIELD,
+)
+atexit.register(cache_writes.flush)
+
+# Per-PDF cap, TTL and invalidation of content no PDF has any more.
+answer_policy = AnswerCachePolicy(
+    cache_col,
+    max_per_pdf=int(os.getenv("KB_CACHE_MAX_PER_PDF", "1000")),
+    ttl_seconds=int(os.getenv("KB_CACHE_TTL_DAYS", "90")) * 86400,
+    interval=int(os.getenv("KB_CACHE_POLICY_SECONDS", "300")),
+    on_evict=semantic_index.remove,
+)
+answer_policy.start()
+
+
+def _cache_filter(content_hash, query):
+    # Entries written before query keys existed only match on the raw query.
+    return {
+        "content_hash": content_hash,
+        "$or": [{"query_key": canonical_query_key(query)}, {"query": query}],
+    }
+
+
+def get_cached_answer(content_hash, query):
+    key = (content_hash, canonical_query_key(query))
+    answer = local_answers.get(key)
+    if answer is None:
+        pending = cache_writes.pending_fields(key)
+        answer = pending["answer"] if pending else None
+    if answer is not None:
+        cache_writes.increment(key, _cache_filter(content_hash, query))
+        return answer + " (From Cache)"
+
+    doc = cache_col.find_one(_cache_filter(content_hash, query), {"answer": 1})
+    if not doc:
+        return None
+    cache_writes.increment(key, _cache_filter(content_hash, query))
+    local_answers.put(key, doc["answer"])
+    return doc["answer"] + " (From Cache)"
+
+
+def store_cached_answer(content_hash, query, answer, embedding=None, pdf_path=None):
+    if embedding is None:
+        embedding = query_embeddings.embed_query(query)
+    # Stored packed at the configured Matryoshka width, like the FAISS stores.
+    embedding = pack_embedding(reduce_dims(embedding, EMBED_DIM))
+    query_key = canonical_query_key(query)
+    key = (content_hash, query_key)
+    # The semantic index only learns the id once the flush has inserted the
+    # entry; an entry that already existed is in the index under its own id.
+    cache_writes.upsert(
+        key,
+        {"content_hash": content_hash, "query_key": query_key},
+        {"answer": answer, "embedding": embedding, "updated_at": datetime.utcnow()},
+        {"_id": ObjectId(), "pdf_path": pdf_path, "query": query, "created_at": datetime.utcnow()},
+        on_upserted=lambda doc_id: semantic_index.add(content_hash, doc_id, embedding),
     )
-    return doc["answer"] + " (From Cache)" if doc else None
-
-
-def store_cached_answer(pdf_path, query, answer):
-    embedding = embedding_model.embed_query(query)
-    existing = cache_col.find_one({"pdf_path": pdf_path, "query": query})
-
-    if existing:
-        cache_col.update_one(
-            {"pdf_path": pdf_path, "query": query},
-            {
-                "$set": {
-                    "answer": answer,
-                    "embedding": embedding,
-                    "updated_at": datetime.utcnow()
-                },
-                "$inc": {"hit_count": 1}
-            }
-        )
-    else:
-        cache_col.insert_one({
-            "pdf_path": pdf_path,
-            "query": query,
-            "answer": answer,
-            "embedding": embedding,
-            "created_at": datetime.utcnow(),
-            "hit_count": 1
-        })
+    local_answers.put(key, answer)
+    answer_policy.note_store(content_hash)
 
 
 # === Folder Listing ===
-def list_kb_folders():
-    kb_list = []
+# Listings are served from an in-memory manifest revalidated by directory mtimes.
+kb_manifest = KBManifest(KB_ROOT, check_interval=float(os.getenv("KB_MANIFEST_CHECK_SECONDS", "2")))
 
-    print(f"📂 Scanning KB Root Path2: {KB_ROOT}")
-    print(f"📂 KB Root Contents: {os.listdir(KB_ROOT)}")
 
-    for top in os.listdir(KB_ROOT):
-        top_path = os.path.join(KB_ROOT, top)
-        if not os.path.isdir(top_path):
-            continue
+def kb_listing_etag(*variant):
+    return kb_manifest.etag(*variant)
+
 
+def list_kb_folders():
+    # The manifest may re-list the tree between these calls; a folder removed
+    # in between lists as empty instead of failing the whole request.
+    kb_list = []
+
+    for top in (kb_manifest.listing("") or {}).get("dirs", []):
         subfolders = []
-        for sub in os.listdir(top_path):
-            sub_path = os.path.join(top_path, sub)
-            if os.path.isdir(sub_path):
-                pdfs = [f for f in os.listdir(sub_path) if f.endswith(".pdf")]
-                subfolders.append({
-                    "name": sub,
-                    "pdfs": pdfs,
-                    "pdf_count": len(pdfs)
-                })
+        for sub in (kb_manifest.listing(top) or {}).get("dirs", []):
+            pdfs = (kb_manifest.listing(f"{top}/{sub}") or {}).get("pdfs", [])
+            subfolders.append({
+                "name": sub,
+                "pdfs": pdfs,
+                "pdf_count": len(pdfs)
+            })
 
         if subfolders:
             kb_list.append({"folder": top, "subfolders": subfolders})
@@ -132,10 +256,37 @@ def list_kb_folders():
 
 
 def list_kb_folder(folder, subfolder):
-    full_path = os.path.join(KB_ROOT, folder, subfolder)
-    if not os.path.exists(full_path):
+    listing = kb_manifest.listing(f"{folder}/{subfolder}")
+    return listing["pdfs"] if listing else None
+
+
+def list_kb_folder_contents(folder, allowed_folders):
+    """
+    Subfolders and PDFs of a KB folder visible to allowed_folders, or None if the folder does not exist.
+    """
+    listing = kb_manifest.listing(folder)
+    if listing is None:
         return None
-    return [f for f in os.listdir(full_path) if f.endswith(".pdf")]
+
+    contents = []
+    for name in listing["dirs"]:
+        full_folder_path = f"{folder}/{name}"
+        # ✅ Only allow subfolder if user has access
+        if "*" in allowed_folders or full_folder_path in allowed_folders:
+            contents.append({
+                "type": "folder",
+                "name": name,
+                "pdf_count": len((kb_manifest.listing(full_folder_path) or {}).get("pdfs", []))
+            })
+
+    for name in listing["pdfs"]:
+        full_file_path = f"{folder}/{name}"
+        if "*" in allowed_folders or folder in allowed_folders or full_file_path in allowed_folders:
+            contents.append({
+                "type": "file",
+                "name": name
+            })
+    return contents
 
 
 # === Upload ===
@@ -148,6 +299,7 @@ def save_uploaded_pdf(folder, subfolder, file):
     filename = secure_filename(file.filename)
     file_path = os.path.join(upload_path, filename)
     file.save(file_path)
+    kb_manifest.add_pdf(f"{safe_folder}/{safe_subfolder}", filename)
     return safe_folder, safe_subfolder, filename
 
 
@@ -157,6 +309,326 @@ def get_hashed_path(relative_path: str) -> str:
     return hashlib.sha256(normalized.encode()).hexdigest()
 
 
+def kb_relative_path(full_path):
+    return os.path.relpath(full_path, KB_ROOT).replace(os.sep, "/")
+
+
+def hash_file_contents(full_path):
+    sha = hashlib.sha256()
+    with open(full_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+_content_hashes = {}
+
+
+def get_content_hash(full_path):
+    """
+    SHA-256 of the PDF bytes. Served from a per-worker memo, then from the
+    path→content alias table, and only rehashed when the file's mtime or size changed.
+    """
+    st = os.stat(full_path)
+    signature = (st.st_mtime_ns, st.st_size)
+    cached = _content_hashes.get(full_path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    alias_key = kb_relative_path(full_path)
+    alias = alias_col.find_one({"_id": alias_key})
+    if alias and (alias.get("mtime_ns"), alias.get("size")) == signature:
+        content_hash = alias["content_hash"]
+    else:
+        content_hash = hash_file_contents(full_path)
+        alias_col.update_one(
+            {"_id": alias_key},
+            {"$set": {
+                "content_hash": content_hash,
+                "mtime_ns": st.st_mtime_ns,
+                "size": st.st_size,
+                "updated_at": datetime.utcnow()
+            }},
+            upsert=True
+        )
+        if alias and alias["content_hash"] != content_hash:
+            _content_replaced(alias["content_hash"])
+
+    _content_hashes[full_path] = (signature, content_hash)
+    return content_hash
+
+
+def _content_replaced(old_hash):
+    # Answers and page text of content no KB path holds any more are never needed again.
+    if alias_col.find_one({"content_hash": old_hash}, {"_id": 1}):
+        return
+    print(f"♻️ PDF content {old_hash[:12]} replaced; invalidating its cached answers")
+    local_answers.invalidate(old_hash)
+    answer_policy.invalidate_content(old_hash)
+    page_texts.delete(old_hash)
+
+
+def _extract_pages(full_path):
+    print(f"📄 Parsing PDF ({resolve_backend()}): {full_path}")
+    return load_pages(full_path)
+
+
+def load_pdf_pages(full_path, content_hash=None):
+    """
+    (text, metadata) per page of a KB PDF; the PDF is parsed only the first time its content is seen.
+    """
+    content_hash = content_hash or get_content_hash(full_path)
+    return page_texts.load_or_extract(content_hash, lambda: _extract_pages(full_path))
+
+
+def _load_vector_store(vector_store_path):
+    print(f"📁 Loading vector store at: {vector_store_path}")
+    if has_chunk_store(vector_store_path):
+        return ChunkStoreIndex(vector_store_path, embedding_model)
+    # Stores built before the chunk store existed still carry a pickled docstore.
+    return FAISS.load_local(vector_store_path, embeddings=embedding_model, allow_dangerous_deserialization=True)
+
+
+def vector_store_path_for(content_hash):
+    return os.path.join(VECTOR_STORE_DIR, content_hash)
+
+
+def iter_pdf_pages(full_path, content_hash):
+    """
+    Yield (text, metadata) per page of a KB PDF, one page at a time: read from
+    the page-text store, or parsed and stored as they are yielded.
+    """
+    if page_texts.page_count(content_hash) is not None:
+        for _, text, metadata in page_texts.iter_pages(content_hash):
+            yield text, metadata
+        return
+    print(f"📄 Parsing PDF ({resolve_backend()}): {full_path}")
+    yield from page_texts.store_pages(content_hash, iter_page_documents(full_path))
+
+
+def build_vector_store(full_path, content_hash, force=False, progress=None):
+    """
+    Embed a PDF into its content-addressed store. Only one process builds a
+    given store at a time; the result is written to a temp directory and
+    published with an atomic rename. Pages are streamed through the splitter
+    and embedded in batches; progress(totals) is called after each batch.
+    """
+    vector_store_path = vector_store_path_for(content_hash)
+
+    def build_into(tmp_dir):
+        print(f"📄 Embedding PDF: {full_path}")
+        spec, totals = ingest_pages(
+            tmp_dir,
+            iter_pdf_pages(full_path, content_hash),
+            RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200),
+            lambda texts: chunk_embeddings.embed_documents(texts, embedding_model),
+            # Known only if the PDF was parsed before; a first ingest counts pages as they stream.
+            page_count=page_texts.page_count(content_hash),
+            progress=progress,
+            index_type=INDEX_TYPE,
+            embedding_model=EMBEDDING_MODEL_NAME,
+            chunk_size=1000,
+            chunk_overlap=200,
+        )
+        print(f"🧮 Chunk embeddings: {totals['cached']} cached, {totals['chunks'] - totals['cached']} embedded")
+        print(f"🗂️ Built {spec['type']} index over {totals['chunks']} chunks from {totals['pages']} pages")
+        with open(os.path.join(tmp_dir, "checksum.txt"), "w") as f:
+            f.write(content_hash)
+
+    if build_store_atomically(vector_store_path, build_into, LOCK_DIR, force=force):
+        print(f"💾 Saved vector store at {vector_store_path}")
+    else:
+        print(f"✅ Vector store already built by another worker: {vector_store_path}")
+    return vector_store_cache.get(content_hash, vector_store_path, _load_vector_store)
+
+
+def enqueue_pdf_ingest(path, force=False):
+    """
+    Queue a background build of the vector store for a KB path ('folder/subfolder/pdf').
+    Returns the job id, or None when a store for the PDF content already exists and force is False.
+    """
+    full_path = resolve_kb_pdf(path)
+    content_hash = get_content_hash(full_path)
+    if not force and is_complete_store(vector_store_path_for(content_hash)):
+        return None
+    return ingest_jobs.submit(
+        content_hash, path, lambda progress: build_vector_store(full_path, content_hash, force=force, progress=progress)
+    )
+
+
+def get_ingest_job(job_id):
+    return ingest_jobs.get(job_id)
+
+
+_bundle_lock = threading.Lock()
+_bundle = {"signature": None, "bundle": None}
+
+
+def get_vector_bundle():
+    """
+    The memory-mapped vector store bundle built by `embed_kb.py --build-bundle`,
+    reopened when the file is replaced. None if no bundle exists.
+    """
+    try:
+        st = os.stat(VECTOR_BUNDLE_PATH)
+    except FileNotFoundError:
+        return None
+    signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _bundle_lock:
+        if _bundle["signature"] != signature:
+            _bundle["bundle"] = VectorBundle(VECTOR_BUNDLE_PATH)
+            _bundle["signature"] = signature
+            print(f"📦 Opened vector bundle with {len(_bundle['bundle'])} stores")
+        return _bundle["bundle"]
+
+
+def get_vector_store(path, content_hash):
+    """
+    Return the loaded vector store for a PDF's content, served from the
+    worker's LRU cache. A missing store is queued for a background build
+    (or joins the one in flight) and briefly polled for; if it is still not
+    ready, IndexingInProgress is raised instead of blocking the request.
+    IndexingFailed is raised instead of queueing again while the store's last
+    build failure is recent.
+    """
+    bundle = get_vector_bundle()
+    if bundle is not None and content_hash in bundle:
+        return bundle.store(content_hash)
+
+    vector_store_path = vector_store_path_for(content_hash)
+
+    if not is_complete_store(vector_store_path):
+        failed = ingest_jobs.find_recent_failure(content_hash)
+        if failed:
+            raise IndexingFailed(failed)
+        print("📄 No vector store found — queueing ingestion")
+        job_id = enqueue_pdf_ingest(path)
+        if not wait_for_store(vector_store_path, BUILD_WAIT_SECONDS):
+            failed = ingest_jobs.find_recent_failure(content_hash)
+            if failed:
+                raise IndexingFailed(failed)
+            raise IndexingInProgress(job_id)
+
+    return vector_store_cache.get(content_hash, vector_store_path, _load_vector_store)
+
+
+def prewarm_vector_stores(limit):
+    """
+    Load the vector stores of the PDFs with the highest total hit_count
+    in kb_answer_cache into this worker's vector store cache.
+    """
+    pipeline = [
+        {"$match": {"content_hash": {"$exists": True}}},
+        {"$group": {"_id": "$content_hash", "hits": {"$sum": "$hit_count"}}},
+        {"$sort": {"hits": -1}},
+        {"$limit": limit},
+    ]
+    warmed = 0
+    for row in cache_col.aggregate(pipeline):
+        content_hash = row["_id"]
+        vector_store_path = vector_store_path_for(content_hash)
+        if not is_complete_store(vector_store_path):
+            continue
+        try:
+            vector_store_cache.get(content_hash, vector_store_path, _load_vector_store)
+            warmed += 1
+        except Exception as e:
+            print(f"⚠️ Prewarm failed for {content_hash}: {e}")
+    print(f"🔥 Prewarmed {warmed} vector stores")
+    return warmed
+
+
+def get_kb_cache_stats():
+    return {
+        "vector_stores": vector_store_cache.stats(),
+        "vector_bundle_stores": len(get_vector_bundle() or ()),
+        "query_embeddings": query_embeddings.stats(),
+        "single_flight": ask_flights.stats(),
+        "semantic_index": semantic_index.stats(),
+        "answers": local_answers.stats(),
+        "write_behind": cache_writes.stats(),
+    }
+
+
+PREWARM_TOP_N = int(os.getenv("KB_PREWARM_TOP_N", "0"))
+if PREWARM_TOP_N > 0:
+    threading.Thread(target=prewarm_vector_stores, args=(PREWARM_TOP_N,), daemon=True).start()
+
+
+def retrieve_chunks(db, query, query_vector):
+    """
+    Chunks to stuff into the prompt: hybrid BM25 + dense for stores with a
+    lexical index, dense similarity search otherwise (bundles, legacy stores).
+    """
+    if getattr(db, "lexical", None) is not None:
+        return db.hybrid_search_by_vector(query, query_vector, k=HYBRID_K, fetch_k=HYBRID_FETCH_K)
+    return db.similarity_search_by_vector(query_vector, k=RETRIEVAL_K)
+
+
+def build_prompt_context(db, query, query_vector):
+    """
+    Retrieve chunks and pack them into the ask_kb context budget. Returns
+    the documents for the "stuff" prompt and that prompt, whose size is logged.
+    """
+    docs, packing = pack_context(retrieve_chunks(db, query, query_vector), CONTEXT_TOKENS)
+    prompt = STUFF_PROMPT.format(context=SEPARATOR.join(doc.page_content for doc in docs), question=query)
+    print(
+        f"🧾 Prompt ≈{estimate_tokens(prompt)} tokens: {packing['chunks']} chunks → {packing['passages']} passages, "
+        f"context {packing['context_tokens']}/{packing['budget_tokens']} tokens (unpacked {packing['unpacked_tokens']})"
+    )
+    return docs, prompt
+
+
+def _answer_uncached(path, full_path, content_hash, query):
+    # === Step 2: Semantic match
+    # The query is embedded once and reused for the semantic match,
+    # the vector search and the cache write below.
+    query_vector = query_embeddings.embed_query(query)
+    semantic_match = get_semantic_match(content_hash, query_vector)
+    if semantic_match:
+        print("✅ Found semantic match")
+        return semantic_match
+
+    # === Step 3: Vector search fallback
+    db = get_vector_store(path, content_hash)
+
+    print("🔍 Performing similarity search")
+    relevant_docs, _ = build_prompt_context(db, query, query_vector)
+
+    print("🤖 Calling LLM for final answer")
+    chain = load_qa_chain(Ollama(model=model,base_url= base_url), chain_type="stuff")
+    answer = chain.run(input_documents=relevant_docs, question=query)
+
+    store_cached_answer(content_hash, query, answer, embedding=query_vector, pdf_path=full_path)
+    print("✅ Answer generated and cached")
+
+    return answer + " (From LLM)"
+
+
+def _answer_and_flush(path, full_path, content_hash, query):
+    # Followers in other workers re-check Mongo as soon as the leader is done,
+    # so the leader writes its answer through instead of leaving it buffered.
+    answer = _answer_uncached(path, full_path, content_hash, query)
+    cache_writes.flush()
+    return answer
+
+
+def resolve_kb_pdf(path):
+    """
+    Map a KB path ('folder/subfolder/pdf') to the PDF on disk, raising FileNotFoundError.
+    """
+    parts = path.split("/")
+    if len(parts) != 3:
+        raise FileNotFoundError("Invalid path format. Expected 'folder/subfolder/pdf'")
+
+    folder, subfolder, pdf = parts
+    full_path = os.path.join(KB_ROOT, folder, subfolder, pdf)
+
+    if not os.path.exists(full_path):
+        raise FileNotFoundError("PDF not found")
+    return full_path
+
+
 def ask_kb_path(path, query):
     try:
         print(f"🟢 Ask KB called with path: {path}, question: {query}")
@@ -164,69 +636,123 @@ def ask_kb_path(path, query):
         if not path or not query:
             return "Missing path or query"
 
-        parts = path.split("/")
-        if len(parts) != 3:
-            raise FileNotFoundError("Invalid path format. Expected 'folder/subfolder/pdf'")
-
-        folder, subfolder, pdf = parts
-        full_path = os.path.join(KB_ROOT, folder, subfolder, pdf)
-
-        if not os.path.exists(full_path):
-            raise FileNotFoundError("PDF not found")
+        full_path = resolve_kb_pdf(path)
+        content_hash = get_content_hash(full_path)
 
         # === Step 1: Exact cache
-        cached = get_cached_answer(full_path, query)
+        cached = get_cached_answer(content_hash, query)
         if cached:
             print("✅ Found exact cached answer")
             return cached
 
-        # === Step 2: Semantic match
-        semantic_match = get_semantic_match(full_path, query)
-        if semantic_match:
-            print("✅ Found semantic match")
-            return semantic_match
+        # === Steps 2-3 run once per (PDF content, question) across concurrent requests
+        flight_key = f"{content_hash}:{canonical_query_key(query)}"
+        return ask_flights.do(
+            flight_key,
+            lambda: _answer_and_flush(path, full_path, content_hash, query),
+            recheck=lambda: get_cached_answer(content_hash, query),
+        )
 
-        # === Step 3: Vector search fallback
-        relative_path = os.path.join("KB", path)
-        path_hash = get_hashed_path(relative_path)
-        vector_store_path = os.path.join(VECTOR_STORE_DIR, path_hash)
+    except IndexingInProgress:
+        print("⏳ Vector store is still being built")
+        raise
+    except IndexingFailed as e:
+        print(f"❌ {e}")
+        raise
+    except Exception as e:
+        print("❌ Ask KB Exception:", str(e))
+        import traceback
+        traceback.print_exc()
+        raise e
 
-        print(f"📁 Loading vector store at: {vector_store_path}")
 
-        if os.path.exists(vector_store_path):
-            db = FAISS.load_local(vector_store_path, embeddings=embedding_model, allow_dangerous_deserialization=True)
-            print("✅ Vector store loaded")
-        else:
-            print("📄 No vector store found — re-embedding PDF")
-            loader = PyPDFLoader(full_path)
-            pages = loader.load_and_split()
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            docs = text_splitter.split_documents(pages)
-            db = FAISS.from_documents(docs, embedding_model)
-            db.save_local(vector_store_path)
-            print(f"💾 Saved vector store at {vector_store_path}")
+# === Streaming Ask KB (SSE) ===
+PG13_BLOCKED_MESSAGE = "⚠️ This response was blocked to comply with PG-13 safety guidelines."
 
-        print("🔍 Performing similarity search")
-        relevant_docs = db.similarity_search(query)
 
-        print("🤖 Calling LLM for final answer")
-        chain = load_qa_chain(Ollama(model=model,base_url= base_url), chain_type="stuff")
-        answer = chain.run(input_documents=relevant_docs, question=query)
+def _sse(event):
+    return f"data: {json.dumps(event)}\n\n"
 
-        store_cached_answer(full_path, query, answer)
-        print("✅ Answer generated and cached")
 
-        return answer + " (From LLM)"
+def _complete_words_end(text):
+    # Index just past the last non-word character; what follows may be a partial word.
+    return len(text) - len(re.search(r"\w*$", text).group())
+
+
+def stream_ask_kb(path, full_path, query):
+    """
+    Server-sent events for /ask-kb-stream. Cache hits are sent as a single
+    'answer' event; misses stream 'token' events from the LLM and the full
+    answer is cached once the stream completes. Text failing the PG-13 check
+    ends the stream with a 'blocked' event and is not cached.
+    """
+    try:
+        print(f"🟢 Ask KB stream called with path: {path}, question: {query}")
+
+        content_hash = get_content_hash(full_path)
+        cached = get_cached_answer(content_hash, query)
+        source = "cache"
+        if not cached:
+            query_vector = query_embeddings.embed_query(query)
+            cached = get_semantic_match(content_hash, query_vector)
+            if cached:
+                source = "semantic_cache"
+
+        if cached:
+            if not is_safe_text(cached):
+                yield _sse({"type": "blocked", "response": PG13_BLOCKED_MESSAGE})
+                return
+            yield _sse({"type": "answer", "source": source, "response": cached})
+            return
+
+        try:
+            db = get_vector_store(path, content_hash)
+        except IndexingInProgress as ip:
+            yield _sse({"type": "status", "status": "indexing", "job_id": ip.job_id})
+            return
+        except IndexingFailed as fail:
+            yield _sse({"type": "status", "status": "failed", "job_id": fail.job_id, "error": str(fail)})
+            return
+
+        _, prompt = build_prompt_context(db, query, query_vector)
+
+        print("🤖 Streaming LLM answer")
+        parts, sent = [], 0
+        for token in Ollama(model=model, base_url=base_url).stream(prompt):
+            parts.append(token)
+            text = "".join(parts)
+            # A word still being streamed is held back: "kill" may become "killed".
+            complete = _complete_words_end(text)
+            if complete <= sent:
+                continue
+            if not is_safe_text(text[:complete]):
+                yield _sse({"type": "blocked", "response": PG13_BLOCKED_MESSAGE})
+                return
+            yield _sse({"type": "token", "content": text[sent:complete]})
+            sent = complete
+
+        answer = "".join(parts)
+        if not is_safe_text(answer):
+            yield _sse({"type": "blocked", "response": PG13_BLOCKED_MESSAGE})
+            return
+        if len(answer) > sent:
+            yield _sse({"type": "token", "content": answer[sent:]})
+        store_cached_answer(content_hash, query, answer, embedding=query_vector, pdf_path=full_path)
+        print("✅ Streamed answer cached")
+        yield _sse({"type": "done", "source": "llm"})
 
     except Exception as e:
-        print("❌ Ask KB Exception:", str(e))
+        print("❌ Ask KB Stream Exception:", str(e))
         import traceback
         traceback.print_exc()
-        raise e
+        yield _sse({"type": "error", "error": str(e)})
 
 
 # === Read PDF Text for TTS ===
-def read_kb_pdf(path):
+def resolve_kb_read_path(path):
+    """
+    Full path of a 'folder/subfolder/pdf' KB path, or None if it is malformed or missing.
+    """
     parts = path.split("/")
     if len(parts) != 3:
         return None
@@ -234,9 +760,36 @@ def read_kb_pdf(path):
     full_path = os.path.join(KB_ROOT, folder, subfolder, pdf)
     if not os.path.exists(full_path):
         return None
-    loader = PyPDFLoader(full_path)
-    docs = loader.load()
-    return "\n".join([page.page_content for page in docs])
+    return full_path
+
+
+def read_kb_pdf(path):
+    full_path = resolve_kb_read_path(path)
+    if not full_path:
+        return None
+    return "\n".join(text for text, _ in load_pdf_pages(full_path))
+
+
+def kb_pdf_page_count(full_path, content_hash):
+    count = page_texts.page_count(content_hash)
+    return count if count is not None else pdf_page_count(full_path)
+
+
+def iter_kb_pdf_pages(full_path, content_hash, start=0, end=None):
+    """
+    Yield (page number, text) for pages start <= page < end. Stored pages are
+    read lazily from the page-text store; a PDF seen for the first time is
+    parsed page by page, yielding each page as soon as it is extracted and
+    storing pages as it goes.
+    """
+    if page_texts.page_count(content_hash) is not None:
+        for page, text, _ in page_texts.iter_pages(content_hash, start, end):
+            yield page, text
+        return
+
+    for page, (text, _) in enumerate(iter_pdf_pages(full_path, content_hash)):
+        if start <= page and (end is None or page < end):
+            yield page, text
 
 
 # === List KB Folders Based on Allowed Access ===
@@ -268,9 +821,7 @@ def extract_text_from_pdf(relative_path):
     if not os.path.isfile(full_path):
         return None
 
-    loader = PyPDFLoader(full_path)
-    docs = loader.load()
-    return "\n".join([page.page_content for page in docs])
+    return "\n".join(text for text, _ in load_pdf_pages(full_path))
 
 
 # === New: List Cached Questions for a PDF ===
@@ -282,11 +833,213 @@ def list_cached_questions(pdf_path):
     if not os.path.isabs(pdf_path):
         pdf_path = os.path.join(KB_ROOT, pdf_path.replace("/", os.sep))
 
+    if os.path.isfile(pdf_path):
+        docs = cache_col.find({"content_hash": get_content_hash(pdf_path)}, {"query": 1, "hit_count": 1})
+    else:
+        docs = cache_col.find({"pdf_path": pdf_path}, {"query": 1, "hit_count": 1})
+
     questions = []
-    docs = cache_col.find({"pdf_path": pdf_path})
     for doc in docs:
         questions.append({
             "query": doc.get("query", ""),
             "hit_count": doc.get("hit_count", 1)
         })
-    return questions
\ No newline at end of file
+    return questions
+
+
+# === Answer cache policy ===
+def get_answer_cache_admin_stats():
+    return {
+        "policy": answer_policy.stats(),
+        "write_behind": cache_writes.stats(),
+        "local_answers": local_answers.stats(),
+        "semantic_index": semantic_index.stats(),
+        "kb_manifest": kb_manifest.stats(),
+    }
+
+
+def apply_answer_cache_policy():
+    """
+    Create the policy indexes, date legacy entries and enforce the per-PDF cap on every PDF.
+    """
+    answer_policy.ensure_indexes()
+    dated = answer_policy.backfill_last_used()
+    evicted = answer_policy.run_once(cache_col.distinct("content_hash"))
+    print(f"🧹 Dated {dated} legacy cache entries, evicted {evicted} over the per-PDF cap")
+    return evicted
+
+
+# === Migration to canonical query keys ===
+def backfill_cache_query_keys(batch_size=500):
+    """
+    Add query_key to kb_answer_cache entries written before canonical keys
+    existed, and re-key entries whose key no longer matches how their
+    question folds (e.g. "-3" once folded to "3"). An entry whose new key is
+    already taken duplicates that entry and is dropped. Then make
+    (content_hash, query_key) unique, merging entries whose questions fold
+    to the same key.
+    """
+    updated, dropped, batch = 0, [], []
+
+    def flush():
+        nonlocal updated
+        ops = [UpdateOne({"_id": doc_id}, {"$set": {"query_key": query_key}}) for doc_id, query_key in batch]
+        try:
+            updated += cache_col.bulk_write(ops, ordered=False).modified_count
+        except BulkWriteError as e:
+            updated += e.details.get("nModified", 0)
+            duplicates = [batch[error["index"]][0] for error in e.details.get("writeErrors", [])
+                          if error.get("code") == DUPLICATE_KEY]
+            if len(duplicates) < len(e.details.get("writeErrors", [])):
+                raise
+            cache_col.delete_many({"_id": {"$in": duplicates}})
+            semantic_index.remove(duplicates)
+            dropped.extend(duplicates)
+        batch.clear()
+
+    for doc in cache_col.find({}, {"query": 1, "query_key": 1}):
+        query_key = canonical_query_key(doc.get("query", ""))
+        if doc.get("query_key") != query_key:
+            batch.append((doc["_id"], query_key))
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+    answer_policy.ensure_unique_key()
+    print(f"🔑 Set query keys on {updated} cache entries, dropped {len(dropped)} duplicates")
+    return updated
+
+
+# === Migration to content-addressed storage ===
+def backfill_cache_content_hashes():
+    """
+    Tag legacy kb_answer_cache entries (keyed only by pdf_path) with the content
+    hash of the PDF currently at that path. Entries of missing PDFs are left alone.
+    """
+    updated = 0
+    for pdf_path in cache_col.distinct("pdf_path", {"content_hash": {"$exists": False}}):
+        if not pdf_path or not os.path.isfile(pdf_path):
+            continue
+        result = cache_col.update_many(
+            {"pdf_path": pdf_path, "content_hash": {"$exists": False}},
+            {"$set": {"content_hash": get_content_hash(pdf_path)}}
+        )
+        updated += result.modified_count
+    print(f"🏷️ Tagged {updated} cache entries with content hashes")
+    return updated
+
+
+def migrate_legacy_vector_stores():
+    """
+    Rename vector stores keyed by get_hashed_path("KB/<path>") to the content
+    hash of the PDF, so existing indexes are reused without re-embedding.
+    """
+    moved = 0
+    for root, _, files in os.walk(KB_ROOT):
+        for name in files:
+            if not name.lower().endswith(".pdf"):
+                continue
+            full_path = os.path.join(root, name)
+            legacy_path = os.path.join(VECTOR_STORE_DIR, get_hashed_path(os.path.join("KB", kb_relative_path(full_path))))
+            target_path = vector_store_path_for(get_content_hash(full_path))
+            if os.path.isdir(legacy_path) and not os.path.exists(target_path):
+                os.rename(legacy_path, target_path)
+                moved += 1
+                print(f"📦 {kb_relative_path(full_path)} → {target_path}")
+    print(f"📦 Moved {moved} vector stores")
+    return moved
+
+
+def build_lexical_indexes():
+    """
+    Add BM25 tables to chunk stores built before hybrid retrieval. Stores
+    still holding a pickled docstore need --reencode-vector-stores instead.
+    """
+    added = skipped = 0
+    for name in sorted(os.listdir(VECTOR_STORE_DIR)):
+        store_path = os.path.join(VECTOR_STORE_DIR, name)
+        if name.startswith(".") or not is_complete_store(store_path):
+            continue
+        if not has_chunk_store(store_path):
+            skipped += 1
+            continue
+        if add_lexical_index(store_path):
+            added += 1
+            print(f"🔤 {name}: BM25 index added")
+    print(f"🔤 Added {added} lexical indexes ({skipped} pickled stores skipped)")
+    return added
+
+
+# === Re-encoding without re-embedding ===
+def reencode_vector_stores(embed_dim=None, vector_dtype=None, index_type=None):
+    """
+    Rebuild every vector store from the vectors it already holds, truncated to
+    embed_dim and stored as vector_dtype (defaults: KB_EMBED_DIM / KB_VECTOR_DTYPE).
+    Truncation is one-way; stores already at or below embed_dim keep their width.
+    Website stores (web_*) are skipped; a store that fails is reported and left as is.
+    """
+    rebuilt = failed = 0
+    for name in sorted(os.listdir(VECTOR_STORE_DIR)):
+        store_path = os.path.join(VECTOR_STORE_DIR, name)
+        if name.startswith((".", "web_")) or not is_complete_store(store_path):
+            continue
+        try:
+            _reencode_vector_store(name, store_path, embed_dim, vector_dtype, index_type)
+            rebuilt += 1
+        except Exception as e:
+            print(f"❌ {name}: re-encoding failed: {e}")
+            failed += 1
+    print(f"🗜️ Re-encoded {rebuilt} vector stores ({failed} failed)")
+    return rebuilt
+
+
+def _reencode_vector_store(name, store_path, embed_dim, vector_dtype, index_type):
+    vectors, docs = read_faiss_store(store_path)
+    checksum_file = os.path.join(store_path, "checksum.txt")
+    if os.path.exists(checksum_file):
+        with open(checksum_file, "r") as f:
+            checksum = f.read().strip()
+    else:
+        # Stores built on demand are named after their content hash and have no checksum file.
+        checksum = name
+    manifest = read_manifest(store_path) or {}
+
+    def build_into(tmp_dir):
+        spec = save_chunk_store_index(
+            tmp_dir, vectors, docs,
+            index_type=index_type or INDEX_TYPE,
+            embed_dim=embed_dim,
+            vector_dtype=vector_dtype,
+            embedding_model=manifest.get("embedding_model", EMBEDDING_MODEL_NAME),
+            chunk_size=manifest.get("chunk_size", 1000),
+            chunk_overlap=manifest.get("chunk_overlap", 200),
+        )
+        print(f"🗜️ {name}: {len(docs)} chunks, {spec}")
+        with open(os.path.join(tmp_dir, "checksum.txt"), "w") as f:
+            f.write(checksum)
+
+    build_store_atomically(store_path, build_into, LOCK_DIR, force=True)
+
+
+def pack_cache_embeddings(embed_dim=None, batch_size=500):
+    """
+    Convert kb_answer_cache embeddings in place to packed BinData
+    (KB_CACHE_EMBED_DTYPE), truncating wider ones to embed_dim (default KB_EMBED_DIM).
+    """
+    embed_dim = EMBED_DIM if embed_dim is None else embed_dim
+    updated, batch = 0, []
+    for doc in cache_col.find({"embedding": {"$exists": True}}, {"embedding": 1}):
+        stored = doc["embedding"]
+        vector = unpack_embedding(stored)
+        if is_packed_embedding(stored) and not (embed_dim and len(vector) > embed_dim):
+            continue
+        packed = pack_embedding(reduce_dims(vector, embed_dim))
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"embedding": packed}}))
+        if len(batch) >= batch_size:
+            updated += cache_col.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += cache_col.bulk_write(batch, ordered=False).modified_count
+    width = f"{embed_dim} dims" if embed_dim else "full width"
+    print(f"🗜️ Packed {updated} cached embeddings as {CACHE_EMBED_DTYPE} at {width}")
+    return updated
@@ -0,0 +1,148 @@
+# services/lexical_index.py
+
+import math
+import re
+import sqlite3
+from array import array
+from collections import Counter
+
+import numpy as np
+
+TOKEN_RE = re.compile(r"\w+")
+# Only the most frequent function words; BM25's idf already discounts the rest.
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i in is it its of on or that the "
+    "their this to was were what when where which who why will with".split()
+)
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Reciprocal rank fusion constant; 60 is the usual choice and keeps one
+# list's top hit from drowning out agreement between both lists.
+RRF_K = 60
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+class LexicalIndexBuilder:
+    """
+    Postings for a BM25 inverted index, accumulated chunk by chunk in FAISS
+    position order, and written as bm25_* tables next to the chunks table.
+    """
+
+    def __init__(self):
+        self.postings = {}  # term -> (positions, term frequencies)
+        self.lengths = array("i")
+
+    def add(self, text):
+        pos = len(self.lengths)
+        counts = Counter(tokenize(text))
+        self.lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            entry = self.postings.get(term)
+            if entry is None:
+                entry = self.postings[term] = (array("i"), array("i"))
+            entry[0].append(pos)
+            entry[1].append(tf)
+
+    def write(self, conn):
+        lengths = np.frombuffer(self.lengths.tobytes(), dtype=np.int32)
+        conn.execute("DROP TABLE IF EXISTS bm25_terms")
+        conn.execute("DROP TABLE IF EXISTS bm25_meta")
+        conn.execute(
+            "CREATE TABLE bm25_terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL,"
+            " positions BLOB NOT NULL, tfs BLOB NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute("CREATE TABLE bm25_meta (chunks INTEGER NOT NULL, avg_length REAL NOT NULL, lengths BLOB NOT NULL)")
+        conn.executemany(
+            "INSERT INTO bm25_terms (term, df, positions, tfs) VALUES (?, ?, ?, ?)",
+            [
+                (term, len(positions), np.asarray(positions, dtype=np.int32).tobytes(), np.asarray(tfs, dtype=np.int32).tobytes())
+                for term, (positions, tfs) in self.postings.items()
+            ],
+        )
+        conn.execute(
+            "INSERT INTO bm25_meta (chunks, avg_length, lengths) VALUES (?, ?, ?)",
+            (len(lengths), float(lengths.mean()) if len(lengths) else 0.0, lengths.tobytes()),
+        )
+        conn.commit()
+
+
+def has_lexical_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bm25_meta'").fetchone() is not None
+
+
+class LexicalIndex:
+    """
+    BM25 search over the bm25_* tables of a chunk store's SQLite file. Only
+    chunk lengths are kept in memory; each search reads the postings of the
+    query's terms.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        conn = self._connect()
+        try:
+            chunks, avg_length, lengths = conn.execute("SELECT chunks, avg_length, lengths FROM bm25_meta").fetchone()
+        finally:
+            conn.close()
+        self.count = chunks
+        self.avg_length = avg_length or 1.0
+        self.lengths = np.frombuffer(lengths, dtype=np.int32).astype(np.float32)
+
+    @classmethod
+    def open(cls, db_path):
+        """
+        The lexical index stored in db_path, or None for stores built without one.
+        """
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            present = has_lexical_index(conn)
+        finally:
+            conn.close()
+        return cls(db_path) if present else None
+
+    def _connect(self):
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+
+    def search(self, query, k=20):
+        """
+        [(position, score)] of the k best BM25 matches, best first; chunks sharing no term with the query are left out.
+        """
+        terms = sorted(set(tokenize(query)))
+        if not terms or not self.count:
+            return []
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT df, positions, tfs FROM bm25_terms WHERE term IN ({','.join('?' * len(terms))})", terms
+            ).fetchall()
+        finally:
+            conn.close()
+
+        scores = np.zeros(self.count, dtype=np.float32)
+        norms = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths / self.avg_length)
+        for df, positions, tfs in rows:
+            positions = np.frombuffer(positions, dtype=np.int32)
+            tfs = np.frombuffer(tfs, dtype=np.int32).astype(np.float32)
+            idf = math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+            scores[positions] += idf * tfs * (BM25_K1 + 1) / (tfs + norms[positions])
+
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        top = matched[np.argsort(-scores[matched], kind="stable")[:k]]
+        return [(int(pos), float(scores[pos])) for pos in top]
+
+
+def reciprocal_rank_fusion(*rankings, k=RRF_K):
+    """
+    Fuse ranked lists of positions: each position scores the sum of
+    1 / (k + rank) over the lists it appears in. Returns positions, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, pos in enumerate(ranking):
+            scores[pos] = scores.get(pos, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda pos: -scores[pos])
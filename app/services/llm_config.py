@@ -8,3 +8,14 @@ LLM_MODELS = {
     "ask_website": os.environ["ASK_WEBSITE_MODEL"],
     "generate_insights": os.environ["GENERATE_INSIGHTS_MODEL"],
 }
+
+# Token budget for retrieved context packed into each feature's prompt
+# (see services/context_packing.py), keyed like LLM_MODELS.
+LLM_CONTEXT_TOKENS = {
+    "normal_chat": int(os.getenv("NORMAL_CHAT_CONTEXT_TOKENS", "2048")),
+    "ask_pdf": int(os.getenv("ASK_PDF_CONTEXT_TOKENS", "1024")),
+    "ask_kb": int(os.getenv("ASK_KB_CONTEXT_TOKENS", "1024")),
+    "ask_db": int(os.getenv("ASK_DB_CONTEXT_TOKENS", "2048")),
+    "ask_website": int(os.getenv("ASK_WEBSITE_CONTEXT_TOKENS", "2048")),
+    "generate_insights": int(os.getenv("GENERATE_INSIGHTS_CONTEXT_TOKENS", "2048")),
+}
@@ -0,0 +1,122 @@
+# services/page_text_store.py
+
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+INSERT_PAGE = "INSERT OR REPLACE INTO pages (content_hash, page, text, metadata) VALUES (?, ?, ?, ?)"
+
+
+class PageTextStore:
+    """
+    Extracted text of every PDF page keyed by (content hash, page number),
+    zlib-compressed in SQLite. A PDF is parsed once; reading, previewing and
+    re-chunking afterwards never reopen it. WAL mode lets the server and
+    embed_kb.py workers share one file.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " content_hash TEXT PRIMARY KEY, page_count INTEGER NOT NULL,"
+                " text_bytes INTEGER NOT NULL, created_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                " content_hash TEXT NOT NULL, page INTEGER NOT NULL,"
+                " text BLOB NOT NULL, metadata TEXT NOT NULL,"
+                " PRIMARY KEY (content_hash, page)) WITHOUT ROWID"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def page_count(self, content_hash):
+        """
+        Number of stored pages, or None if the document was never extracted.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT page_count FROM documents WHERE content_hash = ?", (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, content_hash, pages):
+        """
+        Store a document's pages, an iterable of (text, metadata) in page order.
+        """
+        for _ in self.store_pages(content_hash, pages):
+            pass
+
+    def store_pages(self, content_hash, pages, batch_size=64):
+        """
+        Pass (text, metadata) pages through while storing them, committing every
+        batch_size pages, so a document is never held in memory whole. The
+        documents row is written after the last page: a document counts as
+        present only once all of its pages are, and a consumer that stops
+        early leaves it absent. Rows are replaced rather than cleared first, so
+        two processes storing the same content never remove each other's pages.
+        """
+        conn = self._connect()
+        try:
+            rows, count, text_bytes = [], 0, 0
+            for number, (text, metadata) in enumerate(pages):
+                encoded = text.encode("utf-8")
+                rows.append((content_hash, number, zlib.compress(encoded), json.dumps(metadata, default=str)))
+                count += 1
+                text_bytes += len(encoded)
+                if len(rows) >= batch_size:
+                    with conn:
+                        conn.executemany(INSERT_PAGE, rows)
+                    rows = []
+                yield text, metadata
+            with conn:
+                conn.executemany(INSERT_PAGE, rows)
+                conn.execute("DELETE FROM pages WHERE content_hash = ? AND page >= ?", (content_hash, count))
+                conn.execute(
+                    "INSERT OR REPLACE INTO documents (content_hash, page_count, text_bytes, created_at) VALUES (?, ?, ?, ?)",
+                    (content_hash, count, text_bytes, time.time()),
+                )
+        finally:
+            conn.close()
+
+    def iter_pages(self, content_hash, start=0, end=None):
+        """
+        Yield (page number, text, metadata) for pages start <= page < end, reading
+        from SQLite as the caller consumes them.
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "SELECT page, text, metadata FROM pages WHERE content_hash = ? AND page >= ? AND page < ? ORDER BY page",
+                (content_hash, start, end if end is not None else 2 ** 62),
+            )
+            for page, text, metadata in cursor:
+                yield page, zlib.decompress(text).decode("utf-8"), json.loads(metadata)
+        finally:
+            conn.close()
+
+    def get_pages(self, content_hash, start=0, end=None):
+        """
+        List of (text, metadata) for the requested page range.
+        """
+        return [(text, metadata) for _, text, metadata in self.iter_pages(content_hash, start, end)]
+
+    def load_or_extract(self, content_hash, extract):
+        """
+        Stored pages of content_hash, calling extract() -> [(text, metadata)] and storing the result on first use.
+        """
+        if self.page_count(content_hash) is not None:
+            return self.get_pages(content_hash)
+        pages = extract()
+        self.put(content_hash, pages)
+        return pages
+
+    def delete(self, content_hash):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM documents WHERE content_hash = ?", (content_hash,))
+            conn.execute("DELETE FROM pages WHERE content_hash = ?", (content_hash,))
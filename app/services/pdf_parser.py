@@ -0,0 +1,127 @@
+# services/pdf_parser.py
+
+import os
+import threading
+
+from pypdf import PdfReader
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # optional fast backend
+    pdfium = None
+
+try:
+    import pymupdf
+except ImportError:  # optional fast backend
+    pymupdf = None
+
+PYPDF = "pypdf"
+PYPDFIUM2 = "pypdfium2"
+PYMUPDF = "pymupdf"
+BACKENDS = (PYMUPDF, PYPDFIUM2, PYPDF)
+
+# "auto" uses the fastest installed backend; pypdf is always available and
+# matches the text PyPDFLoader used to produce.
+PARSER_BACKEND = os.getenv("KB_PDF_PARSER", "auto")
+
+
+# PDFium and MuPDF are not thread-safe; calls into them are serialized per
+# process (ingestion parallelizes across processes instead).
+_native_lock = threading.Lock()
+
+
+def available_backends():
+    installed = {PYPDF: True, PYPDFIUM2: pdfium is not None, PYMUPDF: pymupdf is not None}
+    return [backend for backend in BACKENDS if installed[backend]]
+
+
+def resolve_backend(backend=None):
+    backend = backend or PARSER_BACKEND
+    if backend == "auto":
+        return available_backends()[0]
+    if backend not in available_backends():
+        raise ValueError(f"PDF parser backend '{backend}' is not installed (available: {available_backends()})")
+    return backend
+
+
+def _iter_pypdf(path):
+    reader = PdfReader(path)
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+def _iter_pypdfium2(path):
+    with _native_lock:
+        doc = pdfium.PdfDocument(path)
+        count = len(doc)
+    try:
+        for index in range(count):
+            with _native_lock:
+                page = doc[index]
+                textpage = page.get_textpage()
+                text = textpage.get_text_bounded()
+                textpage.close()
+                page.close()
+            yield text
+    finally:
+        with _native_lock:
+            doc.close()
+
+
+def _iter_pymupdf(path):
+    with _native_lock:
+        doc = pymupdf.open(path)
+    try:
+        for index in range(doc.page_count):
+            with _native_lock:
+                text = doc.load_page(index).get_text()
+            yield text
+    finally:
+        with _native_lock:
+            doc.close()
+
+
+def page_count(path, backend=None):
+    """
+    Number of pages, without extracting any text.
+    """
+    backend = resolve_backend(backend)
+    if backend == PYPDF:
+        return len(PdfReader(path).pages)
+    with _native_lock:
+        if backend == PYPDFIUM2:
+            doc = pdfium.PdfDocument(path)
+            try:
+                return len(doc)
+            finally:
+                doc.close()
+        with pymupdf.open(path) as doc:
+            return doc.page_count
+
+
+_ITERATORS = {PYPDF: _iter_pypdf, PYPDFIUM2: _iter_pypdfium2, PYMUPDF: _iter_pymupdf}
+
+
+def iter_pages(path, backend=None):
+    """
+    Yield (page number, text) one page at a time; only the current page is
+    held in memory, whatever the backend.
+    """
+    for number, text in enumerate(_ITERATORS[resolve_backend(backend)](path)):
+        yield number, text.replace("\r\n", "\n")
+
+
+def iter_page_documents(path, backend=None):
+    """
+    Yield (text, metadata) per page, with the source/page metadata PyPDFLoader produced.
+    """
+    for number, text in iter_pages(path, backend):
+        yield text, {"source": path, "page": number}
+
+
+def load_pages(path, backend=None):
+    return list(iter_page_documents(path, backend))
+
+
+def extract_text(path, backend=None, separator="\n"):
+    return separator.join(text for _, text in iter_pages(path, backend))
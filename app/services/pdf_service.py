@@ -4,10 +4,10 @@ from flask import jsonify
 from werkzeug.utils import secure_filename
 from services.llm_utils import apply_pg13_prompt
 from services.llm_config import LLM_MODELS
+from services.pdf_parser import extract_text
 
 
 from langchain_ollama import ChatOllama
-import PyPDF2
 
 UPLOAD_FOLDER = "uploaded_pdfs"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -27,10 +27,7 @@ def process_pdf_upload(request):
     file.save(filepath)
 
     try:
-        with open(filepath, "rb") as f:
-            reader = PyPDF2.PdfReader(f)
-            text = "\n".join(page.extract_text() or "" for page in reader.pages)
-            pdf_text_store["latest"] = text
+        pdf_text_store["latest"] = extract_text(filepath)
         return jsonify({"message": f"✅ PDF '{filename}' uploaded and processed."})
     except Exception as e:
         return jsonify({"error": f"❌ Failed to read PDF: {str(e)}"}), 500
@@ -0,0 +1,285 @@
+# services/semantic_cache_index.py
+
+import os
+import threading
+import time
+from datetime import timedelta
+
+import faiss
+import numpy as np
+from bson import ObjectId
+
+from services.vector_codec import match_dims, reduce_dims, unpack_embedding
+
+# New cache entries written by other workers are picked up by polling for ids
+# newer than the last one seen. ObjectIds from different processes created in
+# the same second are not ordered, so the poll re-reads a short overlap window.
+CATCH_UP_OVERLAP = timedelta(seconds=5)
+
+# Documents with at most this many cached questions are scored exactly over
+# their own rows; larger ones go through the HNSW graph with a row filter.
+EXACT_FILTER_MAX = int(os.getenv("KB_SEMANTIC_EXACT_MAX", "2048"))
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+
+
+def normalize_vector(vector):
+    vec = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else vec
+
+
+def _new_index(width):
+    index = faiss.IndexHNSWFlat(width, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    return index
+
+
+class SemanticCacheIndex:
+    """
+    One HNSW inner-product index over every cached question embedding in
+    kb_answer_cache, with the PDF content hash of each row as a filter. Rows
+    are pre-normalized, so scores are cosine similarities. Only the index,
+    the row -> (_id, content hash) mapping and a catch-up watermark are held
+    in memory; answers are fetched from Mongo by id.
+
+    The index is saved to path every save_interval seconds (and by save()),
+    so a restarted worker loads it and only polls entries newer than the
+    saved watermark. rebuild() reloads everything from Mongo. With dim set,
+    full-width cached embeddings are Matryoshka-truncated on load.
+    """
+
+    def __init__(self, collection, dim=0, path=None, save_interval=300):
+        self.collection = collection
+        self.dim = dim
+        self.path = path
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._reset()
+
+    def _reset(self):
+        self._index = None
+        self._doc_ids = []  # row -> _id
+        self._rows = {}  # _id -> row
+        self._hashes = []  # row -> content hash, None once removed
+        self._rows_by_hash = {}  # content hash -> [row]
+        self._removed = set()  # rows whose entries were evicted
+        self._watermark = None
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    @property
+    def width(self):
+        return self._index.d if self._index is not None else None
+
+    # === Loading ===
+    def _fetch(self, since_id=None):
+        # Only ids, content hashes and packed embeddings cross the wire.
+        query = {"content_hash": {"$exists": True}, "embedding": {"$exists": True}}
+        if since_id is not None:
+            window_start = since_id.generation_time - CATCH_UP_OVERLAP
+            query["_id"] = {"$gt": ObjectId.from_datetime(window_start)}
+        return self.collection.find(query, {"embedding": 1, "content_hash": 1})
+
+    def _merge(self, docs, advance=True):
+        new_ids, new_hashes, new_vectors = [], [], []
+        for doc in docs:
+            if advance and (self._watermark is None or doc["_id"] > self._watermark):
+                self._watermark = doc["_id"]
+            vector = doc.get("embedding")
+            if vector is None or len(vector) == 0 or doc["_id"] in self._rows:
+                continue
+            vector = normalize_vector(reduce_dims(unpack_embedding(vector), self.dim))
+            if self._index is None:
+                self._index = _new_index(len(vector))
+            if len(vector) != self.width:
+                continue
+            self._rows[doc["_id"]] = len(self._doc_ids) + len(new_ids)
+            new_ids.append(doc["_id"])
+            new_hashes.append(doc["content_hash"])
+            new_vectors.append(vector)
+        if not new_ids:
+            return
+        self._index.add(np.vstack(new_vectors))
+        for doc_id, content_hash in zip(new_ids, new_hashes):
+            self._rows_by_hash.setdefault(content_hash, []).append(len(self._doc_ids))
+            self._doc_ids.append(doc_id)
+            self._hashes.append(content_hash)
+        self._dirty = True
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if not self._load_saved():
+                self._merge(self._fetch())
+            self._loaded = True
+
+    def _load_saved(self):
+        if not self.path or not os.path.isfile(self.path):
+            return False
+        try:
+            with np.load(self.path, allow_pickle=False) as saved:
+                index = faiss.deserialize_index(saved["index"])
+                doc_ids = [ObjectId(row.tobytes()) for row in saved["doc_ids"]]
+                hashes = saved["hashes"].tolist()
+                hash_codes = saved["hash_codes"].tolist()
+                watermark = saved["watermark"].tobytes()
+        except (OSError, ValueError, KeyError, RuntimeError) as e:
+            print(f"⚠️ Could not load semantic cache index, rebuilding: {e}")
+            return False
+        if self.dim and index.d > self.dim:
+            return False  # saved before truncation was configured
+
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        self._index = index
+        self._doc_ids = doc_ids
+        for row, (doc_id, code) in enumerate(zip(doc_ids, hash_codes)):
+            if code < 0:
+                self._hashes.append(None)
+                self._removed.add(row)
+                continue
+            self._rows[doc_id] = row
+            self._hashes.append(hashes[code])
+            self._rows_by_hash.setdefault(hashes[code], []).append(row)
+        self._watermark = ObjectId(watermark) if watermark else None
+        self._merge(self._fetch(self._watermark))
+        print(f"🧠 Loaded semantic cache index: {len(doc_ids)} saved entries")
+        return True
+
+    def rebuild(self):
+        """
+        Discard the in-memory index, reload every cached embedding from Mongo and save it.
+        """
+        with self._lock:
+            self._reset()
+            self._merge(self._fetch())
+            self._loaded = True
+            count = len(self._doc_ids)
+        self.save()
+        return count
+
+    # === Persistence ===
+    def save(self):
+        """
+        Write the index atomically to path; a no-op without a path or changes.
+        """
+        if not self.path:
+            return False
+        with self._lock:
+            if self._index is None or not self._dirty:
+                return False
+            hashes = list(self._rows_by_hash)
+            codes = {content_hash: code for code, content_hash in enumerate(hashes)}
+            payload = {
+                "index": faiss.serialize_index(self._index),
+                "doc_ids": np.frombuffer(b"".join(doc_id.binary for doc_id in self._doc_ids), dtype=np.uint8).reshape(-1, 12),
+                "hashes": np.array(hashes, dtype="U64"),
+                "hash_codes": np.array([codes.get(h, -1) for h in self._hashes], dtype=np.int32),
+                "watermark": np.frombuffer(self._watermark.binary if self._watermark else b"", dtype=np.uint8),
+            }
+            self._dirty = False
+            self._saved_at = time.monotonic()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **payload)
+        os.replace(tmp_path, self.path)
+        return True
+
+    def _maybe_save(self):
+        if self.path and self._dirty and time.monotonic() - self._saved_at >= self.save_interval:
+            self._saved_at = time.monotonic()
+            threading.Thread(target=self.save, daemon=True).start()
+
+    # === Lookups ===
+    def refresh(self, content_hash):
+        """
+        Load the index on first use, afterwards only pull entries added since the
+        last refresh. Returns the number of indexed entries for content_hash.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            since_id = self._watermark
+        docs = list(self._fetch(since_id))
+        with self._lock:
+            self._merge(docs)
+            count = len(self._rows_by_hash.get(content_hash, ()))
+        self._maybe_save()
+        return count
+
+    def best_match(self, content_hash, query_vector):
+        """
+        Return (doc_id, cosine score) of the closest cached question for the
+        content hash (across all PDFs if content_hash is None), or (None, -1).
+        """
+        with self._lock:
+            if self._index is None or self._index.ntotal == 0:
+                return None, -1
+            query = normalize_vector(match_dims(query_vector, self.width))
+            if len(query) != self.width:
+                return None, -1
+            rows = None if content_hash is None else self._rows_by_hash.get(content_hash)
+            if content_hash is not None and not rows:
+                return None, -1
+
+            if rows is not None and len(rows) <= EXACT_FILTER_MAX:
+                # Small documents: exact scores over a view of the HNSW storage.
+                storage = faiss.downcast_index(self._index.storage)
+                flat = faiss.rev_swig_ptr(storage.get_xb(), self._index.ntotal * self.width)
+                scores = np.asarray(flat).reshape(-1, self.width)[rows] @ query
+                best = int(np.argmax(scores))
+                return self._doc_ids[rows[best]], float(scores[best])
+
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = HNSW_EF_SEARCH
+            if rows is not None:
+                selector = faiss.IDSelectorBatch(np.asarray(rows, dtype=np.int64))
+                params.sel = selector
+            elif self._removed:
+                removed = faiss.IDSelectorBatch(np.fromiter(self._removed, dtype=np.int64))
+                selector = faiss.IDSelectorNot(removed)
+                params.sel = selector
+            scores, found = self._index.search(query[None, :], 1, params=params)
+            if found[0][0] < 0:
+                return None, -1
+            return self._doc_ids[int(found[0][0])], float(scores[0][0])
+
+    def add(self, content_hash, doc_id, embedding):
+        # Added rows do not move the watermark, so entries other workers wrote
+        # in the meantime are still picked up by the next refresh.
+        with self._lock:
+            if self._loaded:
+                self._merge([{"_id": doc_id, "content_hash": content_hash, "embedding": embedding}], advance=False)
+
+    def remove(self, doc_ids):
+        """
+        Stop matching evicted entries. HNSW cannot delete, so their rows stay in
+        the graph, filtered out, until the next rebuild().
+        """
+        with self._lock:
+            for doc_id in doc_ids:
+                row = self._rows.pop(doc_id, None)
+                if row is None:
+                    continue
+                content_hash = self._hashes[row]
+                self._rows_by_hash[content_hash].remove(row)
+                if not self._rows_by_hash[content_hash]:
+                    del self._rows_by_hash[content_hash]
+                self._hashes[row] = None
+                self._removed.add(row)
+                self._dirty = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._rows),
+                "removed": len(self._removed),
+                "documents": len(self._rows_by_hash),
+                "dim": self.width,
+                "watermark": str(self._watermark) if self._watermark else None,
+            }
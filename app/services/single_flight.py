@@ -0,0 +1,96 @@
+# services/single_flight.py
+
+import hashlib
+import os
+import threading
+
+from services.file_lock import FileLock
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls. Within a process, followers wait for
+    the leader thread's result. Across processes, the leaders of each worker
+    serialize on a file lock per key, deleted once released; a worker that
+    had to wait first calls recheck() (e.g. a cache lookup) and only computes
+    if that finds nothing. Nobody waits longer than wait_timeout for a leader.
+    """
+
+    def __init__(self, lock_dir=None, wait_timeout=120):
+        self.lock_dir = lock_dir
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+        self.rechecked = 0
+
+    def do(self, key, fn, recheck=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            if not call.done.wait(self.wait_timeout):
+                raise TimeoutError(f"Timed out after {self.wait_timeout}s waiting for the in-flight call")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_leader(key, fn, recheck)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def _run_leader(self, key, fn, recheck):
+        if not self.lock_dir:
+            return fn()
+
+        lock_name = f"flight-{hashlib.sha256(key.encode()).hexdigest()[:32]}.lock"
+        lock = FileLock(os.path.join(self.lock_dir, lock_name), remove_on_release=True)
+        if lock.acquire(blocking=False):
+            try:
+                return fn()
+            finally:
+                lock.release()
+
+        # Another worker is computing the same key: wait for it, then reuse its result.
+        acquired = lock.acquire(timeout=self.wait_timeout)
+        try:
+            if recheck is not None:
+                result = recheck()
+                if result is not None:
+                    with self._lock:
+                        self.rechecked += 1
+                    return result
+            return fn()
+        finally:
+            if acquired:
+                lock.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "rechecked": self.rechecked,
+            }
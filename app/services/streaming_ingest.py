@@ -0,0 +1,65 @@
+# services/streaming_ingest.py
+
+import os
+
+from langchain_core.documents import Document
+
+from services.chunk_store import ChunkStoreWriter
+
+# Chunks sent to the embedding model per request.
+EMBED_BATCH_SIZE = int(os.getenv("KB_EMBED_BATCH_SIZE", "64"))
+
+
+def iter_chunks(pages, splitter):
+    """
+    Yield chunk Documents for an iterable of (text, metadata) pages, splitting
+    one page at a time. Chunks never span pages, so the output matches
+    splitter.split_documents() over the whole document.
+    """
+    for text, metadata in pages:
+        yield from splitter.split_documents([Document(page_content=text, metadata=metadata)])
+
+
+def ingest_pages(store_dir, pages, splitter, embed, batch_size=None, memory_mb=None, page_count=None, progress=None,
+                 index_type=None, embed_dim=None, vector_dtype=None, **manifest_extra):
+    """
+    Build a chunk store in store_dir from an iterable of (text, metadata) pages.
+    Pages are consumed one at a time, split, and embedded batch_size chunks
+    at a time with embed(texts) -> (vectors, cache hits); each batch is
+    appended to a ChunkStoreWriter, so neither the whole document nor all of
+    its chunks are held in memory. progress(totals) is called after every
+    batch; totals["page_count"] is page_count, or None until the last page
+    has been counted when it is not known up front. Returns (index spec, totals).
+    """
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    totals = {"pages": 0, "page_count": page_count, "chunks": 0, "cached": 0}
+    batch = []
+
+    def counted(pages):
+        for page in pages:
+            totals["pages"] += 1
+            yield page
+
+    def flush():
+        vectors, hits = embed([doc.page_content for doc in batch])
+        writer.add(batch, vectors)
+        totals["chunks"] += len(batch)
+        totals["cached"] += hits
+        batch.clear()
+        if progress:
+            progress(dict(totals))
+
+    writer = ChunkStoreWriter(store_dir, embed_dim=embed_dim, memory_mb=memory_mb)
+    try:
+        for doc in iter_chunks(counted(pages), splitter):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        totals["page_count"] = totals["pages"]
+        spec = writer.finish(index_type, vector_dtype, **manifest_extra)
+        totals["spilled"] = writer.spilled
+        return spec, totals
+    finally:
+        writer.close()
@@ -0,0 +1,156 @@
+# services/vector_bundle.py
+
+import json
+import mmap
+import os
+import pickle
+import struct
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from services.ann_index import reconstruct_all
+from services.chunk_store import has_chunk_store, read_chunks
+from services.vector_codec import match_dims
+
+# Layout: MAGIC | 64-byte aligned sections | JSON header | uint64 header length | MAGIC.
+# Per store the sections are: float32 vectors [count, dim], float32 squared
+# norms [count], int64 text offsets [count + 1], UTF-8 texts, int64 metadata
+# offsets [count + 1], JSON metadata. The header maps content hash -> offsets.
+MAGIC = b"KBPACK01"
+ALIGN = 64
+SECTIONS = ("vectors", "norms", "text_offsets", "texts", "meta_offsets", "metas")
+
+
+def _pad(f):
+    remainder = f.tell() % ALIGN
+    if remainder:
+        f.write(b"\0" * (ALIGN - remainder))
+
+
+def _offsets(blobs):
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+    return offsets
+
+
+def read_faiss_store(store_dir):
+    """
+    Load the raw vectors and documents of a vector store directory.
+    """
+    index = faiss.read_index(os.path.join(store_dir, "index.faiss"))
+    vectors = reconstruct_all(index)
+    if has_chunk_store(store_dir):
+        return vectors, read_chunks(store_dir)
+    with open(os.path.join(store_dir, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    docs = [docstore.search(index_to_docstore_id[i]) for i in range(index.ntotal)]
+    return vectors, docs
+
+
+def build_bundle(stores, out_path):
+    """
+    Pack an iterable of (content_hash, vectors, documents) into one bundle file.
+    Stores are consumed one at a time, so a generator keeps memory flat.
+    Written to a temp file and renamed, so open readers keep their old mapping.
+    """
+    tmp_path = f"{out_path}.tmp-{os.getpid()}"
+    layout = {}
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        for content_hash, vectors, docs in stores:
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+            texts = [doc.page_content.encode("utf-8") for doc in docs]
+            metas = [json.dumps(doc.metadata, default=str).encode("utf-8") for doc in docs]
+            blobs = (
+                vectors.tobytes(),
+                np.einsum("ij,ij->i", vectors, vectors).astype(np.float32).tobytes(),
+                _offsets(texts).tobytes(),
+                b"".join(texts),
+                _offsets(metas).tobytes(),
+                b"".join(metas),
+            )
+            entry = {"count": int(vectors.shape[0]), "dim": int(vectors.shape[1])}
+            for name, blob in zip(SECTIONS, blobs):
+                _pad(f)
+                entry[name] = f.tell()
+                f.write(blob)
+            layout[content_hash] = entry
+
+        header = json.dumps({"version": 1, "stores": layout}).encode("utf-8")
+        f.write(header)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(MAGIC)
+    os.replace(tmp_path, out_path)
+    return len(layout)
+
+
+class BundledVectorStore:
+    """
+    Read-only vector store over one section of a bundle. Vectors are a NumPy view
+    on the shared mmap, so every worker process reads the same page-cache pages.
+    Scores are squared L2 distances, like LangChain's default FAISS store.
+    """
+
+    def __init__(self, buffer, entry):
+        self._buffer = buffer
+        count, dim = entry["count"], entry["dim"]
+        self.vectors = np.frombuffer(buffer, dtype=np.float32, count=count * dim, offset=entry["vectors"]).reshape(count, dim)
+        self.norms = np.frombuffer(buffer, dtype=np.float32, count=count, offset=entry["norms"])
+        self.text_offsets = np.frombuffer(buffer, dtype=np.int64, count=count + 1, offset=entry["text_offsets"])
+        self.meta_offsets = np.frombuffer(buffer, dtype=np.int64, count=count + 1, offset=entry["meta_offsets"])
+        self.texts_at = entry["texts"]
+        self.metas_at = entry["metas"]
+
+    def _slice(self, base, offsets, i):
+        return bytes(self._buffer[base + int(offsets[i]):base + int(offsets[i + 1])])
+
+    def document(self, i):
+        return Document(
+            page_content=self._slice(self.texts_at, self.text_offsets, i).decode("utf-8"),
+            metadata=json.loads(self._slice(self.metas_at, self.meta_offsets, i)),
+        )
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        query = match_dims(embedding, self.vectors.shape[1])
+        distances = self.norms - 2 * (self.vectors @ query) + float(query @ query)
+        k = min(k, len(distances))
+        if k == 0:
+            return []
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return [(self.document(int(i)), float(distances[i])) for i in top]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k)]
+
+
+class VectorBundle:
+    """
+    Memory-mapped bundle of many vector stores, opened read-only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        footer = len(self._mmap) - len(MAGIC) - 8
+        if self._mmap[:len(MAGIC)] != MAGIC or self._mmap[-len(MAGIC):] != MAGIC:
+            raise ValueError(f"Not a vector bundle: {path}")
+        (header_len,) = struct.unpack_from("<Q", self._mmap, footer)
+        header = json.loads(bytes(self._mmap[footer - header_len:footer]))
+        self._entries = header["stores"]
+        self._stores = {}
+
+    def __contains__(self, content_hash):
+        return content_hash in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def store(self, content_hash):
+        store = self._stores.get(content_hash)
+        if store is None:
+            store = self._stores[content_hash] = BundledVectorStore(self._mmap, self._entries[content_hash])
+        return store
@@ -0,0 +1,73 @@
+# services/vector_codec.py
+
+import os
+import struct
+
+import numpy as np
+from bson.binary import Binary
+
+# Matryoshka truncation target for nomic-embed-text vectors (0 keeps all 768
+# dimensions) and the storage type of vectors inside FAISS stores.
+EMBED_DIM = int(os.getenv("KB_EMBED_DIM", "0"))
+VECTOR_DTYPE = os.getenv("KB_VECTOR_DTYPE", "float32")
+VECTOR_DTYPES = ("float32", "float16", "int8")
+
+# Query embeddings in kb_answer_cache are stored as BinData: a 2-byte header
+# (format version, element type) followed by little-endian components.
+CACHE_EMBED_DTYPE = os.getenv("KB_CACHE_EMBED_DTYPE", "float16")
+PACKED_VERSION = 1
+_PACKED_HEADER = struct.Struct("<BB")
+_PACKED_DTYPES = {0: "<f4", 1: "<f2"}
+_PACKED_CODES = {"float32": 0, "float16": 1}
+
+
+def reduce_dims(vectors, dim):
+    """
+    Matryoshka truncation as recommended for nomic-embed-text: layer-norm the
+    full vector, keep the first dim components and L2-normalize. Vectors that
+    are already dim wide (or dim is 0) are returned unchanged, so applying it
+    twice is safe. Accepts one vector or a 2-D batch.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not dim or dim >= vectors.shape[-1]:
+        return vectors
+    mean = vectors.mean(axis=-1, keepdims=True)
+    var = vectors.var(axis=-1, keepdims=True)
+    reduced = ((vectors - mean) / np.sqrt(var + 1e-5))[..., :dim]
+    norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+    return reduced / np.where(norms == 0, 1, norms)
+
+
+def match_dims(query, dim):
+    """
+    Bring a full-width query vector to the width of an index built from truncated vectors.
+    """
+    query = np.asarray(query, dtype=np.float32)
+    return reduce_dims(query, dim) if query.shape[-1] > dim else query
+
+
+def pack_embedding(vector, dtype=None):
+    """
+    Encode a vector as versioned BinData for Mongo; ~2-4 bytes per component
+    instead of the ~13 of a BSON double array.
+    """
+    code = _PACKED_CODES[dtype or CACHE_EMBED_DTYPE]
+    data = np.asarray(vector, dtype=_PACKED_DTYPES[code]).tobytes()
+    return Binary(_PACKED_HEADER.pack(PACKED_VERSION, code) + data)
+
+
+def unpack_embedding(value):
+    """
+    Decode a stored embedding to float32, accepting both packed BinData and
+    legacy BSON arrays.
+    """
+    if not isinstance(value, (bytes, bytearray)):
+        return np.asarray(value, dtype=np.float32)
+    version, code = _PACKED_HEADER.unpack_from(value)
+    if version != PACKED_VERSION or code not in _PACKED_DTYPES:
+        raise ValueError(f"Unsupported packed embedding (version {version}, type {code})")
+    return np.frombuffer(value, dtype=_PACKED_DTYPES[code], offset=_PACKED_HEADER.size).astype(np.float32)
+
+
+def is_packed_embedding(value, dtype=None):
+    return isinstance(value, (bytes, bytearray)) and value[1:2] == bytes([_PACKED_CODES[dtype or CACHE_EMBED_DTYPE]])
@@ -0,0 +1,105 @@
+# services/vector_store_cache.py
+
+import os
+import threading
+from collections import OrderedDict
+
+# Files whose stat signature identifies one build of a vector store directory.
+FINGERPRINT_FILES = ("index.faiss", "chunks.sqlite", "index.pkl", "checksum.txt")
+
+
+def store_fingerprint(store_path):
+    """
+    Cheap (name, mtime_ns, size) signature of a vector store directory.
+    A rebuilt or replaced store produces a different fingerprint.
+    """
+    fingerprint = []
+    for name in FINGERPRINT_FILES:
+        try:
+            st = os.stat(os.path.join(store_path, name))
+        except FileNotFoundError:
+            continue
+        fingerprint.append((name, st.st_mtime_ns, st.st_size))
+    return tuple(fingerprint)
+
+
+def store_size_bytes(fingerprint):
+    # On-disk size is a close proxy for the resident size of a loaded FAISS store.
+    return sum(size for _, _, size in fingerprint)
+
+
+class VectorStoreCache:
+    """
+    Bounded LRU of loaded vector stores, keyed by the vector store directory hash.
+    Evicts least recently used stores when either the entry count or the memory
+    budget is exceeded, and reloads a store whose files changed on disk.
+    """
+
+    def __init__(self, max_entries=32, max_bytes=1024 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._stores = OrderedDict()  # key -> (fingerprint, size, store)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    def get(self, key, store_path, loader):
+        """
+        Return the loaded store for key, calling loader(store_path) on a miss
+        or when the files under store_path changed since they were loaded.
+        """
+        fingerprint = store_fingerprint(store_path)
+        with self._lock:
+            cached = self._stores.get(key)
+            if cached and cached[0] == fingerprint:
+                self._stores.move_to_end(key)
+                self.hits += 1
+                return cached[2]
+            if cached:
+                self.reloads += 1
+                self._drop(key)
+            else:
+                self.misses += 1
+
+        store = loader(store_path)
+        self.put(key, fingerprint, store)
+        return store
+
+    def put(self, key, fingerprint, store):
+        size = store_size_bytes(fingerprint)
+        with self._lock:
+            if key in self._stores:
+                self._drop(key)
+            self._stores[key] = (fingerprint, size, store)
+            self._bytes += size
+            # Always keep the newest store, even if it alone exceeds the budget.
+            while len(self._stores) > 1 and (
+                len(self._stores) > self.max_entries or self._bytes > self.max_bytes
+            ):
+                oldest = next(iter(self._stores))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, size, _ = self._stores.pop(key)
+        self._bytes -= size
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._stores
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._stores),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+            }
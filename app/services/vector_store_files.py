@@ -0,0 +1,108 @@
+# services/vector_store_files.py
+
+import glob
+import os
+import shutil
+import time
+import uuid
+
+from services.file_lock import FileLock
+
+# A store directory is usable once it has the vectors plus a docstore: the
+# compact chunk store, or the pickled docstore of older LangChain builds.
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILES = ("chunks.sqlite", "index.pkl")
+# How long a reader waits for a store that is missing only because
+# publish_store is between its two renames.
+SWAP_WAIT_SECONDS = 2.0
+
+
+def _has_store_files(store_path):
+    return os.path.isfile(os.path.join(store_path, INDEX_FILE)) and any(
+        os.path.isfile(os.path.join(store_path, name)) for name in DOCSTORE_FILES
+    )
+
+
+def _stale_dirs(store_path):
+    parent, name = os.path.split(os.path.normpath(store_path))
+    return glob.glob(os.path.join(parent, f".old-{glob.escape(name)}-*"))
+
+
+def is_complete_store(store_path, swap_wait=SWAP_WAIT_SECONDS, poll_interval=0.05):
+    """
+    True if store_path holds a usable store. While a rebuild is being
+    published the store is briefly missing with its old copy moved aside;
+    in that case this waits up to swap_wait seconds for the new one.
+    """
+    if _has_store_files(store_path):
+        return True
+    deadline = time.monotonic() + swap_wait
+    while _stale_dirs(store_path) and time.monotonic() < deadline:
+        time.sleep(poll_interval)
+        if _has_store_files(store_path):
+            return True
+    return False
+
+
+def wait_for_store(store_path, timeout, poll_interval=0.25):
+    """
+    Poll until store_path is complete or timeout seconds passed.
+    """
+    deadline = time.monotonic() + timeout
+    while not is_complete_store(store_path):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(poll_interval)
+    return True
+
+
+def publish_store(tmp_dir, store_path):
+    """
+    Move a fully written store into place with a rename. Replacing an
+    existing store takes two renames; between them the store is missing
+    but its .old- copy exists, which is_complete_store waits out.
+    """
+    if os.path.isdir(store_path):
+        # Either a half-written leftover from an older, non-atomic build or a
+        # store being rebuilt: move it aside first, rename cannot replace a directory.
+        parent, name = os.path.split(os.path.normpath(store_path))
+        stale_dir = os.path.join(parent, f".old-{name}-{uuid.uuid4().hex}")
+        os.rename(store_path, stale_dir)
+        os.rename(tmp_dir, store_path)
+        shutil.rmtree(stale_dir, ignore_errors=True)
+    else:
+        os.rename(tmp_dir, store_path)
+
+
+def build_store_atomically(store_path, build_into, lock_dir, wait_timeout=None, force=False):
+    """
+    Build a vector store under a per-store file lock shared by all processes.
+
+    build_into(tmp_dir) writes the store files into a temporary directory next
+    to store_path, which is then published atomically. If another process
+    published the store while this one waited for the lock, nothing is rebuilt.
+    Returns True when this call built the store.
+    """
+    name = os.path.basename(os.path.normpath(store_path))
+    lock = FileLock(os.path.join(lock_dir, f"{name}.build.lock"))
+    if not lock.acquire(timeout=wait_timeout):
+        raise TimeoutError(f"Timed out waiting for the build of {store_path}")
+    try:
+        if not force and is_complete_store(store_path):
+            return False
+        # Holding the lock, any .old- copy is left over from a publish that crashed.
+        for stale_dir in _stale_dirs(store_path):
+            shutil.rmtree(stale_dir, ignore_errors=True)
+
+        parent = os.path.dirname(os.path.normpath(store_path))
+        tmp_dir = os.path.join(parent, f".tmp-{name}-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            build_into(tmp_dir)
+            publish_store(tmp_dir, store_path)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return True
+    finally:
+        lock.release()
@@ -7,10 +7,13 @@ from langchain_community.document_loaders import WebBaseLoader
 from langchain_community.document_loaders.recursive_url_loader import RecursiveUrlLoader
 from langchain_ollama import OllamaEmbeddings
 from services.llm_config import LLM_MODELS
+from services.chunk_store import ChunkStoreIndex, has_chunk_store, save_chunk_store_index
+from services.vector_store_files import build_store_atomically, is_complete_store
 
 Base_url = os.getenv("BASE_URL")
 embedding_model = OllamaEmbeddings(model="nomic-embed-text", base_url=Base_url)
 VECTOR_STORE_DIR = "vector_stores"
+LOCK_DIR = os.path.join(VECTOR_STORE_DIR, ".locks")
 
 
 def embed_site_handler(request):
@@ -21,12 +24,19 @@ def embed_site_handler(request):
     try:
         hashed = hashlib.sha256(url.encode()).hexdigest()
         vs_path = os.path.join(VECTOR_STORE_DIR, f"web_{hashed}")
-        if os.path.exists(vs_path):
+        if is_complete_store(vs_path):
+            return jsonify({"message": "✅ Already embedded", "id": hashed})
+
+        def build_into(tmp_dir):
+            loader = RecursiveUrlLoader(url=url, max_depth=2, extractor=lambda x: x)
+            docs = loader.load()
+            vectors = embedding_model.embed_documents([doc.page_content for doc in docs])
+            save_chunk_store_index(tmp_dir, vectors, docs)
+
+        # Written to a temp dir and published with a rename, so a failed build
+        # never leaves a directory that looks embedded.
+        if not build_store_atomically(vs_path, build_into, LOCK_DIR):
             return jsonify({"message": "✅ Already embedded", "id": hashed})
-        loader = RecursiveUrlLoader(url=url, max_depth=2, extractor=lambda x: x)
-        docs = loader.load()
-        vectordb = FAISS.from_documents(docs, embedding_model)
-        vectordb.save_local(vs_path)
         return jsonify({"message": f"✅ Embedded site: {url}", "id": hashed})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -38,10 +48,13 @@ def handle_web(request):
     if not question or not vector_id:
         return jsonify({"error": "Missing question or ID"}), 400
     vs_path = os.path.join(VECTOR_STORE_DIR, f"web_{vector_id}")
-    if not os.path.exists(vs_path):
+    if not is_complete_store(vs_path):
         return jsonify({"error": "Vector store not found. Please embed site first."}), 400
     try:
-        vectordb = FAISS.load_local(vs_path, embedding_model, allow_dangerous_deserialization=True)
+        if has_chunk_store(vs_path):
+            vectordb = ChunkStoreIndex(vs_path, embedding_model)
+        else:
+            vectordb = FAISS.load_local(vs_path, embedding_model, allow_dangerous_deserialization=True)
         retriever = vectordb.as_retriever()
         model = LLM_MODELS["ask_website"]
         print(f"🌐 Using model for Ask Website (handle_web): {model}")
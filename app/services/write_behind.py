@@ -0,0 +1,179 @@
+# services/write_behind.py
+
+import threading
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+DUPLICATE_KEY = 11000
+
+
+class WriteBehindBuffer:
+    """
+    Aggregates answer-cache writes per (content hash, query key) and flushes
+    them to Mongo as one unordered bulk_write every flush_interval seconds,
+    or sooner once max_pending keys are buffered. Hit counts are summed;
+    stored answers become upserts that also carry the counted hits. With
+    touch_field set, every write also raises that field to the flush time.
+    An upsert's on_upserted(_id) runs once a flush has actually inserted it.
+    """
+
+    def __init__(self, collection, flush_interval=1.0, max_pending=500, touch_field=None):
+        self.collection = collection
+        self.touch_field = touch_field
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # key -> {"filter", "inc", "set", "set_on_insert"}
+        self._wake = threading.Event()
+        self._thread = None
+        self.flushes = 0
+        self.ops_written = 0
+        self.increments_buffered = 0
+        self.upserts_buffered = 0
+        self.errors = 0
+
+    def _entry(self, key, filter_doc):
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = {
+                "filter": filter_doc, "inc": 0, "set": None, "set_on_insert": None, "on_upserted": None,
+            }
+        return entry
+
+    def increment(self, key, filter_doc, count=1):
+        """
+        Add count to hit_count of the entry matching filter_doc at the next flush.
+        """
+        with self._lock:
+            self._entry(key, filter_doc)["inc"] += count
+            self.increments_buffered += count
+        self._after_write()
+
+    def upsert(self, key, filter_doc, fields, on_insert, count=1, on_upserted=None):
+        """
+        Set fields on the entry matching filter_doc at the next flush, creating
+        it with on_insert when it does not exist yet. count is added to hit_count.
+        on_upserted(_id) is called after the flush if it created the entry.
+        """
+        with self._lock:
+            entry = self._entry(key, filter_doc)
+            entry["filter"] = filter_doc
+            entry["inc"] += count
+            entry["set"] = fields
+            entry["set_on_insert"] = on_insert
+            entry["on_upserted"] = on_upserted
+            self.upserts_buffered += 1
+        self._after_write()
+
+    def pending_fields(self, key):
+        """
+        Fields of an upsert that has not been flushed yet, or None.
+        """
+        with self._lock:
+            entry = self._pending.get(key)
+            return dict(entry["set"]) if entry and entry["set"] else None
+
+    def _after_write(self):
+        self._ensure_thread()
+        if len(self._pending) >= self.max_pending:
+            self._wake.set()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="kb-write-behind", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Write everything buffered so far; failed batches are merged back for the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            ops, entries = [], list(pending.values())
+            now = datetime.utcnow()
+            for entry in entries:
+                update = {"$max": {self.touch_field: now}} if self.touch_field else {}
+                if entry["inc"]:
+                    update["$inc"] = {"hit_count": entry["inc"]}
+                if entry["set"] is not None:
+                    update["$set"] = entry["set"]
+                    update["$setOnInsert"] = entry["set_on_insert"]
+                ops.append(UpdateOne(entry["filter"], update, upsert=entry["set"] is not None))
+            try:
+                result = self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # Unordered: every op without a write error was applied. Ops that
+                # lost an upsert race to another worker (duplicate key) are retried
+                # and now match the entry that won; other rejected ops are dropped.
+                errors = e.details.get("writeErrors", [])
+                retry = {
+                    key: entry for index, (key, entry) in enumerate(pending.items())
+                    if any(error["index"] == index and error.get("code") == DUPLICATE_KEY for error in errors)
+                }
+                print(f"⚠️ Write-behind flush: {len(errors)} of {len(ops)} cache writes rejected, {len(retry)} requeued")
+                self.errors += 1
+                self._requeue(retry)
+                applied = len(ops) - len(errors)
+                self.ops_written += applied
+                self._notify_upserted(entries, {item["index"]: item["_id"] for item in e.details.get("upserted", [])})
+                return applied
+            except PyMongoError as e:
+                print(f"⚠️ Write-behind flush of {len(ops)} cache writes failed, retrying later: {e}")
+                self.errors += 1
+                self._requeue(pending)
+                return 0
+            self.flushes += 1
+            self.ops_written += len(ops)
+            self._notify_upserted(entries, result.upserted_ids)
+            return len(ops)
+
+    def _notify_upserted(self, entries, upserted_ids):
+        for index, doc_id in upserted_ids.items():
+            callback = entries[index]["on_upserted"]
+            if callback is None:
+                continue
+            try:
+                callback(doc_id)
+            except Exception as e:
+                print(f"⚠️ Write-behind upsert callback failed: {e}")
+
+    def _requeue(self, pending):
+        with self._lock:
+            for key, entry in pending.items():
+                current = self._pending.get(key)
+                if current is None:
+                    self._pending[key] = entry
+                    continue
+                current["inc"] += entry["inc"]
+                if current["set"] is None:
+                    current.update(
+                        filter=entry["filter"], set=entry["set"], set_on_insert=entry["set_on_insert"],
+                        on_upserted=entry["on_upserted"],
+                    )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "flushes": self.flushes,
+                "ops_written": self.ops_written,
+                "increments_buffered": self.increments_buffered,
+                "upserts_buffered": self.upserts_buffered,
+                "errors": self.errors,
+            }
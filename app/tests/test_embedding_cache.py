@@ -0,0 +1,23 @@
+from services.embedding_cache import canonical_query_key
+
+
+def test_folds_case_whitespace_and_trailing_punctuation():
+    assert canonical_query_key("What is an integer?") == canonical_query_key("  what is an  integer ?")
+
+
+def test_keeps_minus_sign():
+    assert canonical_query_key("What is -3 + 5?") != canonical_query_key("What is 3 + 5?")
+    assert canonical_query_key("What is -3 + 5?") == "what is -3 + 5"
+
+
+def test_keeps_subtraction():
+    assert canonical_query_key("Is 3 - 4 negative?") != canonical_query_key("Is 3 4 negative?")
+
+
+def test_keeps_decimal_point():
+    assert canonical_query_key("Is 2.5 an integer?") != canonical_query_key("Is 2 5 an integer?")
+    assert canonical_query_key("Is 2.5 an integer?") == "is 2.5 an integer"
+
+
+def test_keeps_punctuation_inside_words():
+    assert canonical_query_key("What's an integer?") == "what's an integer"